@@ -14,6 +14,7 @@ from datetime import datetime
 import fcntl
 import logging
 import pingparser
+import apmetrics
 
 logger = logging.getLogger("ap_utils")
 
@@ -25,35 +26,42 @@ def get_hostname():
 
 
 
-def run_cmd(command):
+def run_cmd(command, logoutput=True):
     """
-    Run the given command as subprocess.check_output.
+    Run the given command in a shell, with stderr merged into stdout.
     Return the returncode and the output.
-    The output is logged as debug.
-    """
-    try:
-        logger.info("Running command: %s" % command)
-        output = subprocess.check_output(command, shell=True,
-                                         universal_newlines=True,
-                                         stderr=subprocess.STDOUT)
+    The output is logged as debug, unless logoutput is False.
+    The time to spawn the process and to run it are recorded in apmetrics.
+    """
+    logger.info("Running command: %s", command)
+    start = time.monotonic()
+    proc = subprocess.Popen(command, shell=True,
+                            universal_newlines=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    spawned = time.monotonic()
+    output, _ = proc.communicate()
+    apmetrics.registry.observe_cmd(spawned - start, time.monotonic() - start)
+    if proc.returncode != 0:
+        logger.error("Failed: %s with returncode %d",
+                     command, proc.returncode)
+    if logoutput:
         logger.debug(output)
-        return 0, output
-    except subprocess.CalledProcessError as err:
-        logger.error("Failed: %s with returncode %d" %
-                      (command, err.returncode))
-        logger.debug(err.output)
-        return err.returncode, err.output
+    return proc.returncode, output
 
 
-def ping(hostname, count=5, interval=None, srcip=None):
+def ping(hostname, count=5, interval=None, srcip=None, timeout=None):
     """
-    Run ping to a host and return output and returncode
+    Run ping to a host and return output and returncode.
+    The timeout in seconds is how long to wait for each reply.
     """
     command = "ping -c%d %s" % (count, hostname)
     if interval is not None:
         command = command + " -i%.2f" % (interval)
     if srcip is not None:
         command = command + " -I%s" % (srcip)
+    if timeout is not None:
+        command = command + " -W%g" % (timeout)
     ret, output = run_cmd(command)
     return ret, output
 
@@ -62,19 +70,41 @@ def ping_parsed(hostname, count=5, timeout=None):
     """
     Run ping and return the output parsed as a dictionary object
     """
-    ret, output = ping(hostname, count, timeout)
+    ret, output = ping(hostname, count, timeout=timeout)
     parsedDict = pingparser.parse(output)
     return ret, parsedDict
 
 
-def check_ping(hostname):
+def check_ping(hostname, srcip=None, timeout=1):
     """
     Check the reachability of a host
     """
-    ret, output = ping(hostname, 1)
+    ret, output = ping(hostname, 1, srcip=srcip, timeout=timeout)
     return ret, output
 
 
+def get_intf(ip):
+    """
+    Return the name of the network interface with the given IP address,
+    or None if there is no such interface.
+    """
+    ret, output = run_cmd("ip -o address show to %s" % ip)
+    if ret != 0 or output.strip() == "":
+        return None
+    # e.g. "2: eth0    inet 10.0.0.1/24 brd ..."
+    return output.split()[1]
+
+
+def intf_up(intf):
+    """
+    Return True if the interface is up and has an IPv4 address,
+    and the output of ip address list.
+    """
+    ret, output = run_cmd("ip address list %s" % intf)
+    up = ret == 0 and "UP" in output and "inet " in output
+    return up, output
+
+
 def cycle_interface(intf):
     """
     Bring the interface down, and then up.
@@ -1,4 +1,7 @@
+import time
 import pingparser
+import aprecord
+import apicmp
 from ap_utils import *
 
 class apdelay:
@@ -6,15 +9,22 @@ class apdelay:
     Measure latency between two nodes: localhost and destip.
     If multi-homed the source interface can be specified with srcip.
     The pings are repeated count times, and interval seconds are
-    the time between each ping packet send.
+    the time between each ping packet send. Each reply is waited for
+    at most timeout seconds. The pktsize is the ping payload size in bytes.
     """
-    def __init__ (self, destip, srcip=None, count=3, interval=0.2, pType="ping"):
+    def __init__ (self, destip, srcip=None, count=3, interval=0.2, pType="ping",
+                  timeout=None, pktsize=None):
         self.srcip = srcip
         self.destip = destip
         self.count = count
         self.interval = interval
+        self.timeout = timeout
+        self.pktsize = pktsize
         self.pType = pType
         self.output = None
+        self.tsdelta = aprecord.NaN
+        self.txfallback = None
+        self.timestamp = None
         self.pDict = None
         self.logger = logging.getLogger("apdelay")
         attrs = vars(self)
@@ -25,12 +35,44 @@ class apdelay:
         """
         Run ping to a host and return returncode and output
         """
+        if self.pType == "kping":
+            return self.kping()
         command = "ping -c%d %s" % (self.count, self.destip)
         if self.interval is not None:
             command = command + " -i%.2f" % (self.interval)
         if self.srcip is not None:
             command = command + " -I%s" % (self.srcip)
-        ret, self.output = run_cmd(command)
+        if self.timeout is not None:
+            command = command + " -W%g" % (self.timeout)
+        if self.pktsize is not None:
+            command = command + " -s%d" % (self.pktsize)
+        self.timestamp = time.time()
+        # the raw output is logged by the caller to the probe log
+        ret, self.output = run_cmd(command, logoutput=False)
+        return ret, self.output
+
+
+    def kping(self):
+        """
+        Ping using kernel timestamps of the ICMP packets, instead of
+        the userspace timestamps of the ping binary.
+        Return returncode and output in the format of ping.
+        """
+        probe = apicmp.icmpprobe(self.destip, srcip=self.srcip, count=self.count,
+                                 interval=self.interval, pktsize=self.pktsize,
+                                 timeout=self.timeout)
+        self.timestamp = time.time()
+        try:
+            ret = probe.run()
+        except OSError as e:
+            self.logger.error("Kernel timestamped ping to %s failed: %s" % (self.destip, e))
+            ret = 2
+        self.output = probe.output()
+        self.tsdelta = probe.tsdelta()
+        self.txfallback = probe.txfallbacks()
+        if self.txfallback > 0:
+            self.logger.debug("Ping to %s: %d replies timed from the userspace send time" %
+                              (self.destip, self.txfallback))
         return ret, self.output
 
 
@@ -55,3 +97,27 @@ class apdelay:
                 self.pDict = None
         return self.pDict
 
+
+    def rtts(self):
+        """
+        Return the round trip times in milliseconds of the ping replies
+        """
+        if self.output is None:
+            return []
+        return pingparser.parse_rtts(self.output)
+
+
+    def parse_record(self, expid, hostname, runid, slip=aprecord.NaN):
+        """
+        Return the output of ping parsed as an aprecord.latrecord object
+        """
+        if self.output is None:
+            return None
+        try:
+            return aprecord.latrecord.from_ping(self.output, expid, hostname,
+                                                self.srcip, self.interval,
+                                                self.pktsize, runid, self.timestamp, slip,
+                                                self.count, self.tsdelta, self.txfallback)
+        except:
+            self.logger.error("Invalid ping output:\n" + self.output)
+            return None
@@ -7,18 +7,102 @@ Contains the following class:
 import os
 import time
 import apdelay
+import aprecord
+import apsched
+import appreflight
+import aphist
+import apmetrics
 import csv
+import itertools
+from datetime import datetime
 from ap_utils import *
 
 EXPTYPES = ["latency", "runtime"]
 
+# seconds to wait for each ping reply
+PING_TIMEOUT = 1
+
+# pingMode in the config to apdelay pType
+PING_MODES = {"ping": "ping", "kernel": "kping"}
+
+probelogger = logging.getLogger("probe")
+
+def open_results(csvfile, journal=None):
+    """
+    Open the results csv file. If a journal of an earlier, interrupted
+    run of the experiment exists, append to the csv file named in it.
+    """
+    if journal is None:
+        return open(csvfile, 'w')
+    resuming = journal.resuming()
+    csvfile = journal.open(csvfile)
+    if resuming and os.path.exists(csvfile):
+        logging.getLogger("apexp").warning("Resuming experiment, appending to %s" % csvfile)
+        return open(csvfile, 'a')
+    return open(csvfile, 'w')
+
+
+def get_sweep_points(config):
+    """
+    Return the list of (pingRepeat, pingInterval, pktSize) settings of a
+    latency experiment: the grid of the lists in config["sweep"], with the
+    settings not in the sweep taken from the config.
+    """
+    sweep = config.get("sweep", {})
+    for key in sweep:
+        if key not in ("pingRepeat", "pingInterval", "pktSizes"):
+            raise Exception("Parameter %s cannot be swept" % key)
+        if not isinstance(sweep[key], list):
+            raise Exception("Parameter %s must be a list of values in the sweep" % key)
+    counts = sweep.get("pingRepeat", [config["pingRepeat"]])
+    intervals = sweep.get("pingInterval", [config["pingInterval"]])
+    pktsizes = sweep.get("pktSizes", config["pktSizes"])
+    return list(itertools.product(counts, intervals, pktsizes))
+
+
+def get_ping_type(config):
+    """
+    Return the apdelay probe type of the pingMode of a latency experiment
+    """
+    mode = config.get("pingMode", "ping")
+    if mode not in PING_MODES:
+        raise Exception("Unsupported pingMode %s, use one of: %s" %
+                        (mode, ', '.join(sorted(PING_MODES))))
+    return PING_MODES[mode]
+
+
+def unit_done(cf, journal, *unit):
+    """
+    Flush the results of a completed unit, then record it in the journal.
+    Both are synced to disk by run_done at the end of the run.
+    """
+    if journal is None:
+        return
+    cf.flush()
+    journal.done(*unit, sync=False)
+
+
+def run_done(journal, *files):
+    """
+    Sync the results files of a completed run to disk, then the journal.
+    A crash of the process loses no completed unit, a crash of the host
+    may repeat or lose the units of the last run.
+    """
+    if journal is None:
+        return
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+    journal.sync()
+
+
 class expruntime:
     """
     Run a given set of commands/scripts and time them.
     This will be used to measure the runtimes for experiment provisioning scripts.
     """
     def __init__(self, expid, csvfile, commands, nruns=1,
-                 runinterval=0, config=None):
+                 runinterval=0, config=None, journal=None, clock=None):
         self.expid = expid
         self.csvfile = csvfile
         self.commands = commands
@@ -26,6 +110,10 @@ class expruntime:
         self.runinterval = runinterval
         self.logger = logging.getLogger("runtime")
         self.config = config
+        self.journal = journal
+        if clock is None:
+            clock = apsched.runclock(runinterval=runinterval)
+        self.clock = clock
         self.reswriter = None
 
     def start(self):
@@ -35,12 +123,24 @@ class expruntime:
         logger = self.logger
         hostname = get_hostname()
         # write to csv as we do each run
-        resfields = ['expid', 'hostname', 'command', 'runid', 'runinterval', 'elapsed_time']
-        with open(self.csvfile, 'w') as cf:
+        resfields = ['expid', 'hostname', 'command', 'runid', 'runinterval', 'elapsed_time',
+                     'timestamp', 'slip']
+        with open_results(self.csvfile, self.journal) as cf:
+            self.csvfile = cf.name
+            # a resumed experiment keeps the run grid of its original start
+            if self.journal is not None:
+                self.clock.epoch = self.journal.record_start(self.clock.starttime)
             self.reswriter = csv.DictWriter(cf, fieldnames=resfields)
-            self.reswriter.writeheader()
+            if cf.tell() == 0:
+                self.reswriter.writeheader()
             for run in range(self.nruns):
-                for cmd in self.commands:
+                commands = [cmd for cmd in self.commands
+                            if self.journal is None or not self.journal.is_done(cmd, run)]
+                if len(commands) == 0:
+                    logger.info("Run %d: already completed", run)
+                    continue
+                slip = self.clock.wait(run)
+                for cmd in commands:
                     ## Careful what you allow to run as the given user
                     logger.info("Starting command: %s" % (cmd))
                     start_time = time.time()
@@ -51,19 +151,34 @@ class expruntime:
                     # update results
                     results = {'expid': self.expid, 'hostname': hostname, 'command': '"' + cmd + '"',
                                'runid': run, 'runinterval': self.runinterval,
-                               'elapsed_time': elapsed_time}
+                               'elapsed_time': elapsed_time, 'timestamp': start_time,
+                               'slip': slip}
                     self.reswriter.writerow(results)
-                    time.sleep(self.runinterval)
+                    unit_done(cf, self.journal, cmd, run)
+                run_done(self.journal, cf)
 
 
 class explatency:
     """
     Run latency experiment locally.
+    Each run pings all destinations, with each of the (count, interval,
+    pktsize) points of a parameter sweep, the runs are scheduled by clock.
+    The RTTs of all pings are added to the histograms in self.hists.
+    The results of each run are kept in self.results as aprecord.latrecord objects.
     """
     def __init__(self, expid, csvfile, destips, nruns=30, srcips=None,
-                 count=10, interval=0.3, runinterval=0, pktsizes=[64]):
+                 count=10, interval=0.3, runinterval=0, pktsizes=[64],
+                 journal=None, clock=None, timeout=None, reach=None, points=None,
+                 ptype="ping"):
         self.expid = expid
         self.csvfile = csvfile
+        self.journal = journal
+        if clock is None:
+            clock = apsched.runclock(runinterval=runinterval)
+        self.clock = clock
+        self.timeout = timeout
+        self.reach = reach
+        self.ptype = ptype
         self.destips = []
         self.srcips = []
         self.nruns = nruns
@@ -71,7 +186,15 @@ class explatency:
         self.interval = interval
         self.runinterval = runinterval
         self.pktsizes = pktsizes
+        # the (count, interval, pktsize) settings of a sweep
+        if points is None:
+            points = [(count, interval, pktsize) for pktsize in pktsizes]
+        self.points = points
         self.results = []
+        self.hists = aphist.histset()
+        self.histfile = None
+        self.rttfile = None
+        self.resfile = None
         self.reswriter = None
         self.logger = logging.getLogger("latency")
         if isinstance(destips, list):
@@ -83,36 +206,40 @@ class explatency:
         elif srcips is not None:
             self.srcips.append(srcips)
 
-    def start_from(self, srcip=None):
+    def probe(self, run, srcip, destip, point, slip, hostname):
         """
-        Start the latency measurement from a given source IP address.
+        Ping destip from srcip once with the (count, interval, pktsize)
+        of the point, and record the results of the run.
         """
         logger = self.logger
-        hostname = get_hostname()
-        for destip in self.destips:
-            for pktsize in self.pktsizes:
-                for run in range(self.nruns):
-                    ad = apdelay.apdelay(destip, srcip=srcip, count=self.count,
-                                         interval=self.interval)
-                    ret, out = ad.ping()
-                    if ret != 0 :
-                        logger.error("Run %d: Ping to %s FAILED" % (run, destip))
-                    else:
-                        logger.info("Run %d: Ping to %s SUCCESS" % (run, destip))
-                        # record to the experiment logs and results files
-                        logger.debug(out)
-                        # parse should return NaN for failed pings
-                        parsed = ad.parse()
-                        parsed.update({'expid': self.expid, 'runid': run, 'srcip': srcip,
-                                       'interval': self.interval, 'pktsize': self.pktsizes,
-                                       'hostname': hostname})
-                        self.reswriter.writerow(parsed)
-                        self.results.append(parsed)
-                        # sleep if any
-                        if self.runinterval > 0:
-                            logger.debug("Run %d: Sleep for %d seconds before next run" %
-                                         (run, self.runinterval))
-                            time.sleep(self.runinterval)
+        count, interval, pktsize = point
+        ad = apdelay.apdelay(destip, srcip=srcip, count=count, interval=interval,
+                             timeout=self.timeout, pktsize=pktsize, pType=self.ptype)
+        ret, out = ad.ping()
+        if self.reach is not None:
+            self.reach.update(srcip, destip, ret == 0)
+        # record the raw output to the probe log
+        probelogger.debug(out)
+        if ret != 0 :
+            logger.error("Run %d: Ping to %s FAILED", run, destip)
+            apmetrics.registry.observe_probe(srcip, destip, count, interval, pktsize, None, 100.0)
+        else:
+            logger.info("Run %d: Ping to %s SUCCESS", run, destip)
+            # record to the results file
+            # parse should return NaN for failed pings
+            rec = ad.parse_record(self.expid, hostname, run, slip)
+            if rec is not None:
+                self.reswriter.writerow(rec.as_row())
+                self.results.append(rec)
+                apmetrics.registry.observe_probe(srcip, destip, count, interval, pktsize,
+                                                 rec.avgping, rec.packet_loss)
+            rtts = ad.rtts()
+            self.hists.record(srcip, destip, count, interval, pktsize, rtts)
+            # a journaled probe is skipped on resume, so its RTTs are kept first
+            if self.rttfile is not None and len(rtts) > 0:
+                aphist.write_rtts(self.rttfile, (srcip, destip, count, interval, pktsize, run),
+                                  rtts)
+        unit_done(self.resfile, self.journal, srcip, destip, count, interval, pktsize, run)
 
     def start(self):
         """
@@ -122,17 +249,48 @@ class explatency:
         self.logger.debug("Explatency parameters:")
         self.logger.debug(', '.join("%s: %s" % item for item in attrs.items()))
         # write to csv as we do each run
-        resfields = ['expid', 'hostname', 'srcip', 'dest', 'interval',
-                     'pktsize', 'runid', 'sent', 'received', 'packet_loss',
-                     'minping', 'avgping', 'maxping','jitter']
-        with open(self.csvfile, 'w') as cf:
-            self.reswriter = csv.DictWriter(cf, fieldnames=resfields)
-            self.reswriter.writeheader()
-            if len(self.srcips) == 0:
-                self.start_from()
-            else:
-                for srcip in self.srcips:
-                    self.start_from(srcip)
+        with open_results(self.csvfile, self.journal) as cf:
+            self.csvfile = cf.name
+            self.resfile = cf
+            # a resumed experiment keeps the run grid of its original start
+            if self.journal is not None:
+                self.clock.epoch = self.journal.record_start(self.clock.starttime)
+            self.reswriter = csv.writer(cf)
+            if cf.tell() == 0:
+                self.reswriter.writerow(aprecord.latrecord.FIELDS)
+            # the RTT histograms are stored next to the csv file once per run,
+            # and rebuilt on resume from the RTTs of the journaled probes
+            self.histfile = aphist.get_histfile(self.csvfile)
+            if self.journal is not None:
+                rttfile = aphist.get_rttfile(self.histfile)
+                if os.path.exists(rttfile):
+                    self.hists = aphist.histset.replay(rttfile, self.journal.completed)
+                self.rttfile = open(rttfile, 'a')
+            srcips = self.srcips if len(self.srcips) > 0 else [None]
+            hostname = get_hostname()
+            # each run pings all destinations from all srcips with all points,
+            # starting from a different point in each run to spread them in time
+            for run in range(self.nruns):
+                shift = run % len(self.points)
+                points = self.points[shift:] + self.points[:shift]
+                units = [(srcip, destip, point) for point in points for srcip in srcips
+                         for destip in self.destips
+                         if self.journal is None or
+                         not self.journal.is_done(srcip, destip, *point, run)]
+                if len(units) == 0:
+                    self.logger.info("Run %d: already completed", run)
+                    continue
+                slip = self.clock.wait(run)
+                for srcip, destip, point in units:
+                    if self.reach is not None and not self.reach.should_probe(srcip, destip, run):
+                        self.logger.debug("Run %d: skipping unreachable %s", run, destip)
+                        continue
+                    self.probe(run, srcip, destip, point, slip, hostname)
+                self.hists.save(self.histfile)
+                run_done(self.journal, cf, self.rttfile)
+            if self.rttfile is not None:
+                self.rttfile.close()
+                self.rttfile = None
         return self.results
 
 
@@ -145,7 +303,8 @@ class experiment:
     collection framework.
     """
     def __init__(self, expid, logdir, config, csvfile, exptype="latency",
-                 nruns=30, runinterval=0, verbose="INFO"):
+                 nruns=30, runinterval=0, verbose="INFO", journal=None,
+                 starttime=None):
         self.expid = expid
         self.exptype = exptype
         self.nruns = nruns
@@ -156,6 +315,8 @@ class experiment:
         self.runinterval = runinterval
         self.name = get_hostname()
         self.config = config
+        self.journal = journal
+        self.starttime = starttime
         # keep track of experiment progress
         self.runid = 0
         self.run_starttime = None
@@ -204,6 +365,32 @@ class experiment:
         return destips
 
 
+    def preflight(self, srcips, destips, timeout, ptype="ping"):
+        """
+        Check the source interfaces and the reachability of the destinations
+        with the probe type ptype.
+        The results are cached in the log directory for preflightTTL seconds.
+        """
+        config = self.config
+        cachefile = os.path.join(self.logdir, "preflight_%s.json" % self.name)
+        reach = appreflight.preflight(cachefile, ttl=config.get("preflightTTL", 300),
+                                      timeout=timeout,
+                                      deadevery=config.get("deadProbeEvery", 10), ptype=ptype)
+        print("Preflight check of %d destinations" % len(destips))
+        reach.check(srcips, destips)
+        return reach
+
+    def get_clock(self, runinterval):
+        """
+        Return the run schedule: from the start time given by the master,
+        on a grid of runSlot seconds if the config has one.
+        """
+        slot = self.config.get("runSlot")
+        if self.starttime is not None:
+            self.logger.info("Experiment starts at %s" %
+                             datetime.fromtimestamp(self.starttime).strftime("%H:%M:%S.%f"))
+        return apsched.runclock(self.starttime, slot=slot, runinterval=runinterval)
+
     def start(self):
         """
         Start the experiment.
@@ -225,9 +412,21 @@ class experiment:
             myips = self.get_myips()
             srcips = self.get_srcips(myips, nodes)
             destips = self.get_destips(nodes, srcips, nodup=nodup)
+            timeout = config.get("pingTimeout", PING_TIMEOUT)
+            points = get_sweep_points(config)
+            if len(points) > 1:
+                logger.info("Parameter sweep of %d points (pingRepeat, pingInterval, pktSize): %s" %
+                            (len(points), points))
+            ptype = get_ping_type(config)
+            reach = None
+            if config.get("preflight", True):
+                reach = self.preflight(srcips, destips, timeout, ptype)
             exp = explatency(self.expid, self.csvfile, destips, srcips=srcips,
                              nruns=self.nruns, count=count, interval=interval,
-                             runinterval=runinterval, pktsizes=pktsizes)
+                             runinterval=runinterval, pktsizes=pktsizes,
+                             journal=self.journal, clock=self.get_clock(runinterval),
+                             timeout=timeout, reach=reach, points=points,
+                             ptype=ptype)
             print("Starting %s experiment" % self.exptype)
             logger.info("Starting %s experiment" % self.exptype)
             try:
@@ -243,7 +442,8 @@ class experiment:
             else:
                 runinterval = self.runinterval
             exp = expruntime(self.expid, self.csvfile, commands, nruns=self.nruns,
-                             runinterval=runinterval, config=config)
+                             runinterval=runinterval, config=config,
+                             journal=self.journal, clock=self.get_clock(runinterval))
             print("Starting %s experiment" % self.exptype)
             logger.info("Starting %s experiment" % self.exptype)
             try:
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+"""
+Mergeable latency histograms.
+
+Contains the following classes:
+ - lathist: log-bucketed histogram of RTTs with bounded size
+ - histset: a lathist for each (srcip, dest, count, interval, pktsize) of
+   an experiment, so the settings of a parameter sweep are kept apart
+
+The RTTs are recorded in microseconds. Values below 256 us have their
+own bucket, larger values are bucketed with 7 bits of mantissa, so the
+relative error of a percentile is below 1% and an hour of RTT range
+needs at most 3328 buckets. The histograms are stored sparsely, and
+merging two of them adds the counts of their buckets, so percentiles
+over any number of runs, workers and experiments are exact up to the
+bucket resolution. Show the merged percentiles of the histograms
+synced to the master with, for example:
+
+    src/aphist.py show /home/aerpawops/nsdi23/results --by pair
+"""
+import argparse
+import os
+import glob
+import gzip
+import json
+import base64
+
+# values below SUB_COUNT are exact, above they have SUB_BITS - 1 bits of mantissa
+SUB_BITS = 8
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+# highest value recorded, larger values are clamped: one hour in us
+MAX_VALUE = 3600 * 1000 * 1000
+
+# version 2 keys the histograms by count and interval as well
+FORMAT_VERSION = 2
+
+
+def value_index(value):
+    """
+    Return the bucket index of the integer value
+    """
+    if value < SUB_COUNT:
+        return value
+    exp = value.bit_length() - SUB_BITS
+    return SUB_COUNT + (exp - 1) * HALF_COUNT + ((value >> exp) - HALF_COUNT)
+
+
+def index_range(index):
+    """
+    Return the lowest and highest value of the bucket index
+    """
+    if index < SUB_COUNT:
+        return index, index
+    exp = (index - SUB_COUNT) // HALF_COUNT + 1
+    mantissa = (index - SUB_COUNT) % HALF_COUNT + HALF_COUNT
+    return mantissa << exp, ((mantissa + 1) << exp) - 1
+
+
+def encode_varints(numbers):
+    out = bytearray()
+    for n in numbers:
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+
+def decode_varints(data):
+    numbers = []
+    n = shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(n)
+            n = shift = 0
+    return numbers
+
+
+class lathist:
+    """
+    Log-bucketed histogram of RTTs. Values are given in milliseconds.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, rtt):
+        """
+        Record one RTT in milliseconds
+        """
+        value = min(max(int(round(rtt * 1000)), 0), MAX_VALUE)
+        index = value_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def record_all(self, rtts):
+        for rtt in rtts:
+            self.record(rtt)
+
+    def merge(self, other):
+        """
+        Add the counts of the other histogram to this one
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def percentile(self, pct):
+        """
+        Return the percentile in milliseconds: the middle of the bucket
+        holding the nearest-rank value, within the exact min and max.
+        """
+        if self.count == 0:
+            return None
+        rank = max(int(-(-pct * self.count // 100)), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lo, hi = index_range(index)
+                value = min(max((lo + hi) / 2.0, self.min), self.max)
+                return value / 1000.0
+        return self.max / 1000.0
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count / 1000.0
+
+    def to_dict(self):
+        """
+        Return the histogram as a compact json-able dictionary: the bucket
+        indexes, delta encoded, and the counts as base64 varints.
+        """
+        indexes = sorted(self.counts)
+        deltas = [b - a for a, b in zip([0] + indexes, indexes)]
+        buckets = encode_varints(n for pair in zip(deltas, (self.counts[i] for i in indexes))
+                                 for n in pair)
+        return {"n": self.count, "sum": self.total, "min": self.min, "max": self.max,
+                "b": base64.b64encode(buckets).decode()}
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls()
+        numbers = decode_varints(base64.b64decode(d["b"]))
+        index = 0
+        for delta, count in zip(numbers[0::2], numbers[1::2]):
+            index += delta
+            hist.counts[index] = count
+        hist.count = d["n"]
+        hist.total = d["sum"]
+        hist.min = d["min"]
+        hist.max = d["max"]
+        return hist
+
+
+class histset:
+    """
+    Latency histograms keyed by (srcip, dest, count, interval, pktsize),
+    stored as gzip compressed json. Histograms of version 1 files have
+    count and interval None.
+    """
+    def __init__(self):
+        self.hists = {}
+
+    def get(self, key):
+        if key not in self.hists:
+            self.hists[key] = lathist()
+        return self.hists[key]
+
+    def record(self, srcip, dest, count, interval, pktsize, rtts):
+        if len(rtts) > 0:
+            self.get((srcip, dest, count, interval, pktsize)).record_all(rtts)
+
+    def merge(self, other):
+        for key, hist in other.hists.items():
+            self.get(key).merge(hist)
+        return self
+
+    def save(self, path):
+        """
+        Write the histograms to path, replacing the old file atomically
+        """
+        data = {"version": FORMAT_VERSION, "unit": "us",
+                "hists": [list(key) + [hist.to_dict()] for key, hist in self.hists.items()]}
+        tmpfile = path + ".tmp"
+        with gzip.open(tmpfile, 'wt') as hf:
+            json.dump(data, hf, separators=(',', ':'))
+        os.replace(tmpfile, path)
+
+    @classmethod
+    def replay(cls, rttfile, completed):
+        """
+        Rebuild the histograms from an rtt file written by write_rtts.
+        Only the units in the set completed are counted, and each once,
+        so the RTTs of a probe repeated after a crash are not counted twice.
+        """
+        unitrtts = {}
+        with open(rttfile, 'r') as rf:
+            for line in rf:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partially written last line
+                    continue
+                unit = tuple(entry[:-1])
+                if unit in completed:
+                    unitrtts[unit] = entry[-1]
+        hs = cls()
+        for (srcip, dest, count, interval, pktsize, runid), rtts in unitrtts.items():
+            hs.record(srcip, dest, count, interval, pktsize, rtts)
+        return hs
+
+    @classmethod
+    def load(cls, path):
+        hs = cls()
+        with gzip.open(path, 'rt') as hf:
+            data = json.load(hf)
+        version = data.get("version")
+        if version not in (1, FORMAT_VERSION):
+            raise Exception("Unsupported histogram file version in %s" % path)
+        for entry in data["hists"]:
+            if version == 1:
+                srcip, dest, pktsize, d = entry
+                key = (srcip, dest, None, None, pktsize)
+            else:
+                key, d = tuple(entry[:-1]), entry[-1]
+            hs.get(key).merge(lathist.from_dict(d))
+        return hs
+
+
+def get_histfile(csvfile):
+    """
+    Return the histogram file stored next to the results csv file
+    """
+    dirname, basename = os.path.split(csvfile)
+    if basename.startswith("results_"):
+        basename = "hist_" + basename[len("results_"):]
+    return os.path.join(dirname, os.path.splitext(basename)[0] + ".json.gz")
+
+
+def get_rttfile(histfile):
+    """
+    Return the append-only file of the RTTs of the probes, stored next to
+    the histogram file
+    """
+    return histfile[:-len(".json.gz")] + ".rtts"
+
+
+def write_rtts(rf, unit, rtts):
+    """
+    Append the RTTs of a probe to the rtt file rf, as a json line of its
+    unit (srcip, dest, count, interval, pktsize, runid) and the RTTs
+    """
+    rf.write(json.dumps(list(unit) + [rtts]) + "\n")
+    rf.flush()
+
+
+def find_histfiles(paths):
+    """
+    Return the histogram files in the given files and directories
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "**", "hist_*.json.gz"),
+                                          recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    """
+    Merge histogram files and show their percentiles
+    Arguments:
+        show PATH...: show the percentiles of the merged histograms
+        merge PATH... -o OUT: write the merged histograms to OUT
+    """
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show = subparsers.add_parser("show", help="show percentiles of merged histograms")
+    show.add_argument("paths", nargs="+", help="histogram files, or directories to search")
+    show.add_argument("-b", "--by", default="pair", choices=["pair", "src", "dest", "all"],
+                      help="merge the histograms per pair of nodes, per src, per dest, or all, "
+                      "for each (count, interval, pktsize) setting")
+    show.add_argument("-p", "--pct", type=float, nargs="+", default=[50, 90, 99, 99.9],
+                      help="the percentiles to show")
+    merge = subparsers.add_parser("merge", help="merge histogram files into one")
+    merge.add_argument("paths", nargs="+", help="histogram files, or directories to search")
+    merge.add_argument("-o", "--output", required=True, help="the merged histogram file")
+    args = parser.parse_args()
+
+    merged = histset()
+    for path in find_histfiles(args.paths):
+        merged.merge(histset.load(path))
+
+    if args.command == "merge":
+        merged.save(args.output)
+        print("Merged %d histograms into %s" % (len(merged.hists), args.output))
+        return
+
+    groups = {}
+    for (srcip, dest, count, interval, pktsize), hist in merged.hists.items():
+        setting = (count, interval, pktsize)
+        key = {"pair": (srcip, dest), "src": (srcip, "*"),
+               "dest": ("*", dest), "all": ("*", "*")}[args.by] + setting
+        groups.setdefault(key, lathist()).merge(hist)
+    print("%-16s %-16s %6s %8s %7s %10s %9s %s" %
+          ("src", "dest", "repeat", "interval", "pktsize", "samples", "mean",
+           ' '.join("%9s" % ("p%g" % p) for p in args.pct)))
+    for key in sorted(groups, key=lambda k: tuple(str(f) for f in k)):
+        hist = groups[key]
+        if hist.count == 0:
+            continue
+        srcip, dest, count, interval, pktsize = ("-" if f is None else f for f in key)
+        print("%-16s %-16s %6s %8s %7s %10d %9.3f %s" %
+              (srcip, dest, count, interval, pktsize, hist.count, hist.mean(),
+               ' '.join("%9.3f" % hist.percentile(p) for p in args.pct)))
+
+
+if __name__ == "__main__":
+    main()
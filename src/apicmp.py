@@ -0,0 +1,288 @@
+"""
+ICMP echo probes with kernel timestamps.
+
+Contains the following class:
+ - icmpprobe: sends ICMP echo requests on a socket, and measures the RTT
+   from the kernel send and receive timestamps of the packets
+
+The RTTs reported by the ping binary are taken in userspace, so they
+include the scheduling delay of ping itself, which grows when the worker
+is busy. With SO_TIMESTAMPING the kernel timestamps each packet when it
+is sent and received, and the RTT is measured between those timestamps.
+If the kernel send timestamp of a packet is not available, the userspace
+send time is used, and the reply is counted in txfallbacks(); if
+SO_TIMESTAMPING is not available, SO_TIMESTAMPNS is used for the receive
+timestamp and all replies fall back. The userspace RTT is measured as
+well, and the mean difference between the two is reported as tsdelta.
+
+An unprivileged ICMP datagram socket is used if net.ipv4.ping_group_range
+allows it, otherwise a raw socket, which needs root or CAP_NET_RAW.
+The output of a probe mimics the output of ping, so that it can be parsed
+and logged the same way.
+"""
+
+import os
+import math
+import time
+import select
+import socket
+import struct
+import logging
+import itertools
+
+# from linux/socket.h and linux/net_tstamp.h, not all exported by the socket module
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SO_TIMESTAMPING = getattr(socket, "SO_TIMESTAMPING", 37)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_RX_SOFTWARE = 1 << 3
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# identifiers of the raw socket probes of this process
+probe_ids = itertools.count((os.getpid() << 4) & 0xffff)
+
+
+def checksum(data):
+    """
+    Return the internet checksum of data
+    """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def timespec(data):
+    """
+    Return the seconds since the epoch in a struct timespec
+    """
+    sec, nsec = struct.unpack("qq", data[:16])
+    return sec + nsec * 1e-9
+
+
+def cmsg_timestamp(ancdata):
+    """
+    Return the kernel software timestamp in the ancillary data, or None
+    """
+    for level, ctype, data in ancdata:
+        if level != socket.SOL_SOCKET:
+            continue
+        if ctype == SCM_TIMESTAMPING and len(data) >= 16:
+            # three timespecs, the software timestamp is the first one
+            ts = timespec(data)
+            if ts > 0:
+                return ts
+        elif ctype == SCM_TIMESTAMPNS and len(data) >= 16:
+            return timespec(data)
+    return None
+
+
+class icmpprobe:
+    """
+    Ping destip count times, every interval seconds, with pktsize bytes
+    of payload, waiting at most timeout seconds for each reply.
+    """
+    def __init__(self, destip, srcip=None, count=3, interval=0.2, pktsize=56, timeout=1):
+        self.destip = destip
+        self.srcip = srcip
+        self.count = count
+        self.interval = interval
+        self.pktsize = pktsize if pktsize is not None else 56
+        self.timeout = timeout if timeout is not None else 1
+        self.logger = logging.getLogger("apicmp")
+        self.sock = None
+        self.raw = False
+        self.txsource = "kernel"
+        self.ident = 0
+        # per reply: (seq, kernel rtt, userspace rtt) in seconds, and whether
+        # the send time is a kernel timestamp
+        self.replies = []
+
+    def open(self):
+        """
+        Open the socket with kernel timestamps enabled
+        """
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        self.ident = next(probe_ids) & 0xffff
+        if self.srcip is not None:
+            self.sock.bind((self.srcip, 0))
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+                                 SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_RX_SOFTWARE |
+                                 SOF_TIMESTAMPING_SOFTWARE | SOF_TIMESTAMPING_OPT_TSONLY)
+        except OSError:
+            self.logger.warning("SO_TIMESTAMPING not available, using SO_TIMESTAMPNS "
+                                "and userspace send times")
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.txsource = "user"
+        self.sock.setblocking(False)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def packet(self, seq):
+        payload = (b"ap-perfmon" * (self.pktsize // 10 + 1))[:self.pktsize]
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        csum = checksum(header + payload)
+        return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, self.ident, seq) + payload
+
+    def read_txstamp(self):
+        """
+        Return the kernel send timestamp from the socket error queue, or None
+        """
+        try:
+            data, ancdata, flags, addr = self.sock.recvmsg(64, 512, MSG_ERRQUEUE)
+        except (BlockingIOError, InterruptedError):
+            return None
+        return cmsg_timestamp(ancdata)
+
+    def drain_txstamps(self, usertx, kerneltx):
+        """
+        Read all send timestamps from the error queue, and return the first
+        one of the packet sent at usertx, or kerneltx if there is none.
+        Timestamps of earlier packets are older than usertx.
+        """
+        if self.txsource != "kernel":
+            return kerneltx
+        while True:
+            ts = self.read_txstamp()
+            if ts is None:
+                return kerneltx
+            if kerneltx is None and ts >= usertx:
+                kerneltx = ts
+
+    def read_reply(self, seq):
+        """
+        Return the kernel receive timestamp of the echo reply of seq, 0 if
+        it has no timestamp, or None if no matching reply was read
+        """
+        try:
+            data, ancdata, flags, addr = self.sock.recvmsg(65535, 512)
+        except (BlockingIOError, InterruptedError):
+            return None
+        if self.raw:
+            # skip the IP header
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < 8:
+            return None
+        icmptype, code, csum, ident, rseq = struct.unpack("!BBHHH", data[:8])
+        if icmptype != ICMP_ECHO_REPLY or rseq != seq:
+            return None
+        # datagram sockets get only their own replies, with the id set by the kernel
+        if self.raw and ident != self.ident:
+            return None
+        return cmsg_timestamp(ancdata) or 0
+
+    def echo(self, seq):
+        """
+        Send one echo request and wait for its reply.
+        Return (kernel rtt, userspace rtt) in seconds and whether the send
+        time is a kernel timestamp, or None if no reply.
+        """
+        packet = self.packet(seq)
+        usertx = time.time()
+        self.sock.sendto(packet, (self.destip, 0))
+        kerneltx = None
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([self.sock], [], [], remaining)
+            if len(readable) == 0:
+                continue
+            kerneltx = self.drain_txstamps(usertx, kerneltx)
+            kernelrx = self.read_reply(seq)
+            if kernelrx is None:
+                continue
+            userrx = time.time()
+            # the send timestamp may be queued after the reply
+            kerneltx = self.drain_txstamps(usertx, kerneltx)
+            if not kernelrx:
+                kernelrx = userrx
+            if kerneltx is None:
+                return (kernelrx - usertx, userrx - usertx, False)
+            return (kernelrx - kerneltx, userrx - usertx, True)
+
+    def run(self):
+        """
+        Send the probes. Return 0 if any reply was received, 1 otherwise.
+        """
+        self.replies = []
+        self.open()
+        try:
+            start = time.monotonic()
+            for seq in range(1, self.count + 1):
+                if seq > 1:
+                    wait = start + (seq - 1) * self.interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                rtts = self.echo(seq)
+                if rtts is not None:
+                    self.replies.append((seq,) + rtts)
+        finally:
+            self.close()
+        return 0 if len(self.replies) > 0 else 1
+
+    def rtts(self):
+        """
+        Return the kernel timestamped RTTs in milliseconds
+        """
+        return [krtt * 1000 for seq, krtt, urtt, ktx in self.replies]
+
+    def tsdelta(self):
+        """
+        Return the mean difference between the userspace and kernel RTTs
+        in milliseconds, NaN if there were no replies
+        """
+        if len(self.replies) == 0:
+            return float('nan')
+        return sum(urtt - krtt for seq, krtt, urtt, ktx in self.replies) * 1000 / len(self.replies)
+
+    def txfallbacks(self):
+        """
+        Return the number of replies whose RTT is measured from the
+        userspace send time, for lack of a kernel send timestamp
+        """
+        return sum(1 for seq, krtt, urtt, ktx in self.replies if not ktx)
+
+    def output(self):
+        """
+        Return the results in the format of the output of ping
+        """
+        lines = ["PING %s (%s) %d(%d) bytes of data." % (self.destip, self.destip,
+                                                        self.pktsize, self.pktsize + 28)]
+        for seq, krtt, urtt, ktx in self.replies:
+            lines.append("%d bytes from %s: icmp_seq=%d time=%.3f ms (user %.3f ms%s)" %
+                         (self.pktsize + 8, self.destip, seq, krtt * 1000, urtt * 1000,
+                          "" if ktx else ", user send time"))
+        received = len(self.replies)
+        loss = 100.0 * (self.count - received) / self.count if self.count > 0 else 0
+        lines.append("")
+        lines.append("--- %s ping statistics ---" % self.destip)
+        lines.append("%d packets transmitted, %d received, %g%% packet loss" %
+                     (self.count, received, loss))
+        rtts = self.rtts()
+        if received > 0:
+            avg = sum(rtts) / received
+            mdev = math.sqrt(max(sum(r * r for r in rtts) / received - avg * avg, 0))
+            lines.append("rtt min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f ms" %
+                         (min(rtts), avg, max(rtts), mdev))
+            lines.append("kernel send timestamps for %d of %d replies, "
+                         "user-kernel rtt delta %.3f ms" %
+                         (received - self.txfallbacks(), received, self.tsdelta()))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+
+"""
+Index of the latency and runtime results collected in a log directory.
+
+The results_*.csv files are ingested incrementally into a local SQLite
+database: each file is read from where the previous ingest stopped, so
+re-running the ingest after more results are synced only reads the new
+rows. The query command returns per-pair aggregates over a time range
+of a per-run metric of the csv files, e.g. the weekly p99 of the average
+RTT of the runs between two hosts:
+
+    src/apindex.py ingest /home/aerpawops/nsdi23/results
+    src/apindex.py query -d /home/aerpawops/nsdi23/results \
+        -s 152.14.188.23 -t 152.14.188.24 --since 90d --bucket week
+
+These are percentiles over the runs, one value per run, not over the
+individual RTTs. For the percentiles of the RTTs use aphist.py.
+"""
+import argparse
+import os
+import sys
+import re
+import csv
+import glob
+import math
+import time
+import sqlite3
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger("apindex")
+
+DBNAME = "results_index.sqlite"
+
+# results_<hostname>_<exptype>_<expid>_<YYYYmmdd-HHMMSS>.csv
+resfile_matcher = re.compile(r'results_(.+)_([a-z]+)_(\d+)_(\d{8}-\d{6})\.csv$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    exptype TEXT,
+    header TEXT,
+    offset INTEGER,
+    filetime REAL
+);
+CREATE TABLE IF NOT EXISTS latency (
+    fileid INTEGER,
+    expid INTEGER,
+    hostname TEXT,
+    src TEXT,
+    dest TEXT,
+    ts REAL,
+    interval REAL,
+    pktsize INTEGER,
+    runid INTEGER,
+    sent INTEGER,
+    received INTEGER,
+    packet_loss REAL,
+    minping REAL,
+    avgping REAL,
+    maxping REAL,
+    jitter REAL,
+    count INTEGER
+);
+CREATE INDEX IF NOT EXISTS latency_pair ON latency (src, dest, ts, expid);
+CREATE TABLE IF NOT EXISTS runtime (
+    fileid INTEGER,
+    expid INTEGER,
+    hostname TEXT,
+    command TEXT,
+    ts REAL,
+    runid INTEGER,
+    runinterval REAL,
+    elapsed_time REAL
+);
+CREATE INDEX IF NOT EXISTS runtime_cmd ON runtime (hostname, command, ts, expid);
+"""
+
+LATENCY_COLUMNS = ('fileid', 'expid', 'hostname', 'src', 'dest', 'ts', 'interval',
+                   'pktsize', 'runid', 'sent', 'received', 'packet_loss',
+                   'minping', 'avgping', 'maxping', 'jitter', 'count')
+RUNTIME_COLUMNS = ('fileid', 'expid', 'hostname', 'command', 'ts', 'runid',
+                   'runinterval', 'elapsed_time')
+
+BUCKETS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+STATS = ('count', 'loss', 'min', 'p50', 'avg', 'p90', 'p99', 'max')
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value):
+        return None
+    return value
+
+
+def parse_time(value):
+    """
+    Parse a time given as seconds since the epoch, as a duration before now
+    like 90d, 12h or 30m, or as an UTC date YYYY-mm-dd[ HH:MM[:SS]].
+    """
+    if value is None:
+        return None
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    match = re.match(r'^(\d+)([mhdw])$', value)
+    if match:
+        return time.time() - int(match.group(1)) * units[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse time: %s" % value)
+
+
+def format_time(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def bucket_start(ts, bucket):
+    """
+    Return the start of the UTC time bucket containing ts.
+    Weeks start on Monday.
+    """
+    if bucket == "month":
+        dt = datetime.fromtimestamp(ts, timezone.utc)
+        return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp()
+    width = BUCKETS[bucket]
+    # 1970-01-01 was a Thursday, shift by 3 days so that weeks start on Monday
+    offset = 3 * 86400 if bucket == "week" else 0
+    return ((ts + offset) // width) * width - offset
+
+
+def percentile(values, pct):
+    """
+    Return the nearest-rank percentile of the sorted list values.
+    """
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class resindex:
+    """
+    SQLite index over the results files in a log directory.
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.executescript(SCHEMA)
+        # indexes from before the count column
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(latency)")]
+        if 'count' not in columns:
+            self.db.execute("ALTER TABLE latency ADD COLUMN count INTEGER")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def ingest_dir(self, logdir):
+        """
+        Ingest the new rows of all results files in logdir.
+        Return the number of rows ingested.
+        """
+        nrows = 0
+        for path in sorted(glob.glob(os.path.join(logdir, "**", "results_*.csv"),
+                                     recursive=True)):
+            nrows += self.ingest_file(path)
+        return nrows
+
+    def ingest_file(self, path):
+        """
+        Ingest the rows of the results file added since the last ingest.
+        Only complete lines are read, a partially written last line is
+        read by the next ingest.
+        """
+        path = os.path.abspath(path)
+        match = resfile_matcher.search(os.path.basename(path))
+        if not match:
+            logger.warning("Skipping file with unknown name format: %s" % path)
+            return 0
+        exptype = match.group(2)
+        if exptype not in ("latency", "runtime"):
+            logger.warning("Skipping file of unknown experiment type: %s" % path)
+            return 0
+
+        cur = self.db.execute("SELECT id, header, offset FROM files WHERE path = ?", (path,))
+        row = cur.fetchone()
+        size = os.path.getsize(path)
+        if row is not None:
+            fileid, header, offset = row
+            if size < offset:
+                # the file was rewritten, ingest it again
+                logger.warning("File %s shrank, ingesting it again" % path)
+                self.db.execute("DELETE FROM %s WHERE fileid = ?" % exptype, (fileid,))
+                header, offset = None, 0
+            elif size == offset:
+                return 0
+        else:
+            filetime = datetime.strptime(match.group(4), "%Y%m%d-%H%M%S").timestamp()
+            cur = self.db.execute("INSERT INTO files (path, exptype, header, offset, filetime) "
+                                  "VALUES (?, ?, NULL, 0, ?)", (path, exptype, filetime))
+            fileid, header, offset = cur.lastrowid, None, 0
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode().splitlines()
+        if header is None and len(lines) > 0:
+            header = lines.pop(0)
+        filetime = self.db.execute("SELECT filetime FROM files WHERE id = ?",
+                                   (fileid,)).fetchone()[0]
+        fields = next(csv.reader([header])) if header else []
+        reader = csv.DictReader(lines, fieldnames=fields)
+        if exptype == "latency":
+            rows = [self.latency_row(fileid, r, filetime) for r in reader]
+            columns = LATENCY_COLUMNS
+        else:
+            rows = [self.runtime_row(fileid, r, filetime) for r in reader]
+            columns = RUNTIME_COLUMNS
+        self.db.executemany("INSERT INTO %s (%s) VALUES (%s)" %
+                            (exptype, ', '.join(columns), ', '.join('?' * len(columns))),
+                            rows)
+        self.db.execute("UPDATE files SET header = ?, offset = ? WHERE id = ?",
+                        (header, offset + end, fileid))
+        self.db.commit()
+        logger.info("Ingested %d rows from %s" % (len(rows), path))
+        return len(rows)
+
+    @staticmethod
+    def latency_row(fileid, r, filetime):
+        # the srcip is empty if the experiment ran without srcips
+        src = r.get('srcip') or r.get('hostname')
+        ts = to_float(r.get('timestamp'))
+        if ts is None:
+            # results from before the timestamp column use the file time
+            ts = filetime
+        return (fileid, to_int(r.get('expid')), r.get('hostname'), src, r.get('dest'), ts,
+                to_float(r.get('interval')), to_int(r.get('pktsize')), to_int(r.get('runid')),
+                to_int(r.get('sent')), to_int(r.get('received')),
+                to_float(r.get('packet_loss')), to_float(r.get('minping')),
+                to_float(r.get('avgping')), to_float(r.get('maxping')),
+                to_float(r.get('jitter')), to_int(r.get('count')))
+
+    @staticmethod
+    def runtime_row(fileid, r, filetime):
+        ts = to_float(r.get('timestamp'))
+        if ts is None:
+            ts = filetime
+        command = (r.get('command') or '').strip('"')
+        return (fileid, to_int(r.get('expid')), r.get('hostname'), command, ts,
+                to_int(r.get('runid')), to_float(r.get('runinterval')),
+                to_float(r.get('elapsed_time')))
+
+    def query(self, src, dest, since=None, until=None, bucket="day", expid=None,
+              pktsize=None, count=None, interval=None, metric="avgping"):
+        """
+        Return a list of (bucket start, stats dict) of the metric of the
+        runs from src to dest, for each time bucket in [since, until).
+        The runs can be limited to one setting of a parameter sweep with
+        pktsize, count (pingRepeat) and interval (pingInterval).
+        The stats are over the per-run values of the metric, one per run,
+        not over the individual RTTs.
+        With bucket "none" there is one bucket, with start None.
+        The loss in stats is the mean packet_loss percentage.
+        """
+        if metric not in ("minping", "avgping", "maxping", "jitter"):
+            raise ValueError("Unsupported metric: %s" % metric)
+        sql = "SELECT ts, %s, packet_loss FROM latency WHERE src = ? AND dest = ?" % metric
+        params = [src, dest]
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND ts < ?"
+            params.append(until)
+        if expid is not None:
+            sql += " AND expid = ?"
+            params.append(expid)
+        if pktsize is not None:
+            sql += " AND pktsize = ?"
+            params.append(pktsize)
+        if count is not None:
+            sql += " AND count = ?"
+            params.append(count)
+        if interval is not None:
+            # the interval is a float read back from the csv
+            sql += " AND abs(interval - ?) < 1e-6"
+            params.append(interval)
+        sql += " ORDER BY ts"
+
+        buckets = {}
+        for ts, value, loss in self.db.execute(sql, params):
+            key = bucket_start(ts, bucket) if bucket != "none" else None
+            values, losses = buckets.setdefault(key, ([], []))
+            if value is not None:
+                values.append(value)
+            if loss is not None:
+                losses.append(loss)
+
+        result = []
+        for key in sorted(buckets, key=lambda k: k or 0):
+            values, losses = buckets[key]
+            values.sort()
+            stats = {'count': len(values),
+                     'loss': sum(losses) / len(losses) if losses else None}
+            if values:
+                stats.update({'min': values[0], 'max': values[-1],
+                              'avg': sum(values) / len(values),
+                              'p50': percentile(values, 50),
+                              'p90': percentile(values, 90),
+                              'p99': percentile(values, 99)})
+            result.append((key, stats))
+        return result
+
+
+def main():
+    """
+    Ingest results into the index, or query it.
+    Arguments:
+        ingest LOGDIR: ingest the new results in LOGDIR
+        query: aggregate the per-run RTT metric from --src to --dest per time bucket
+        --db: the index database, default LOGDIR/results_index.sqlite
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="the index database file, default LOGDIR/%s" % DBNAME)
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log the files ingested")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest", help="ingest new results from a log directory")
+    ingest.add_argument("logdir", help="the directory with the results_*.csv files")
+    query = subparsers.add_parser("query", help="aggregate a per-run RTT metric between two nodes; "
+                                  "the percentiles are over runs, see aphist.py for RTT percentiles")
+    query.add_argument("-d", "--logdir", default=".",
+                       help="the log directory of the index, if --db is not given")
+    query.add_argument("-s", "--src", required=True, help="source IP (or hostname)")
+    query.add_argument("-t", "--dest", required=True, help="destination IP")
+    query.add_argument("--since", help="start time: epoch, YYYY-mm-dd[ HH:MM[:SS]] UTC, "
+                       "or a duration before now like 90d")
+    query.add_argument("--until", help="end time, same format as --since")
+    query.add_argument("-b", "--bucket", default="day",
+                       choices=["hour", "day", "week", "month", "none"],
+                       help="aggregate per UTC time bucket, default day")
+    query.add_argument("-e", "--expid", type=int, help="only this experiment ID")
+    query.add_argument("-p", "--pktsize", type=int, help="only this packet size")
+    query.add_argument("-c", "--count", type=int, help="only this pingRepeat")
+    query.add_argument("-i", "--interval", type=float, help="only this pingInterval")
+    query.add_argument("-m", "--metric", default="avgping",
+                       choices=["minping", "avgping", "maxping", "jitter"],
+                       help="the per-run RTT metric to aggregate, default avgping")
+    args = parser.parse_args()
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setFormatter(logging.Formatter('[%(name)s] %(levelname)s: %(message)s'))
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    dbfile = args.db or os.path.join(args.logdir, DBNAME)
+    index = resindex(dbfile)
+    if args.command == "ingest":
+        start = time.time()
+        nrows = index.ingest_dir(args.logdir)
+        print("Ingested %d rows into %s in %.2f seconds" % (nrows, dbfile, time.time() - start))
+    else:
+        result = index.query(args.src, args.dest, since=parse_time(args.since),
+                             until=parse_time(args.until), bucket=args.bucket,
+                             expid=args.expid, pktsize=args.pktsize, count=args.count,
+                             interval=args.interval, metric=args.metric)
+        print("%-16s %s" % ("bucket", ' '.join("%9s" % s for s in STATS)))
+        for key, stats in result:
+            cols = []
+            for s in STATS:
+                value = stats.get(s)
+                if value is None:
+                    cols.append("%9s" % "-")
+                elif s == 'count':
+                    cols.append("%9d" % value)
+                else:
+                    cols.append("%9.3f" % value)
+            print("%-16s %s" % (format_time(key) if key is not None else "all", ' '.join(cols)))
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
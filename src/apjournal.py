@@ -0,0 +1,121 @@
+"""
+Contains the following class:
+ - journal: append-only journal of completed experiment units
+
+The journal lets an interrupted experiment be restarted with the same
+expID: the units already recorded are skipped, and the results are
+appended to the csv file named in the journal.
+"""
+
+import os
+import json
+import logging
+
+
+class journal:
+    """
+    Append-only journal file. The first line names where the results are
+    written (the csv file of a worker, the log directory of the master),
+    each following line is a json list describing one completed unit,
+    e.g. [srcip, dest, pktsize, runid] or [command, runid], or the start
+    time of the experiment, ["starttime", seconds since the epoch].
+    A unit is written after its results are, and both are synced to disk
+    once per run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.csvfile = None
+        self.completed = set()
+        self.starttime = None
+        self.fh = None
+        self.logger = logging.getLogger("journal")
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """
+        Read the csv file name and the completed units from the journal.
+        A partially written last line is ignored.
+        """
+        with open(self.path, 'r') as jf:
+            for lineno, line in enumerate(jf):
+                line = line.strip()
+                if lineno == 0:
+                    self.csvfile = line
+                    continue
+                try:
+                    unit = tuple(json.loads(line))
+                except ValueError:
+                    self.logger.warning("Ignoring corrupt journal line %d in %s" %
+                                        (lineno + 1, self.path))
+                    continue
+                if len(unit) == 2 and unit[0] == "starttime":
+                    self.starttime = unit[1]
+                else:
+                    self.completed.add(unit)
+        self.logger.info("Journal %s: %d units completed" % (self.path, len(self.completed)))
+
+    def resuming(self):
+        """
+        Return True if the journal existed before, i.e. results are to be appended.
+        """
+        return self.csvfile is not None
+
+    def open(self, csvfile):
+        """
+        Open the journal for appending. A new journal records csvfile,
+        an existing one keeps the csv file it was started with.
+        Return the csv file to be used for the results.
+        """
+        if self.csvfile is None:
+            self.csvfile = csvfile
+            self.fh = open(self.path, 'w')
+            self.fh.write(csvfile + "\n")
+            self.sync()
+        else:
+            self.fh = open(self.path, 'a+')
+            # terminate a partially written last line
+            if self.fh.tell() > 0:
+                self.fh.seek(self.fh.tell() - 1)
+                if self.fh.read(1) != "\n":
+                    self.fh.write("\n")
+        return self.csvfile
+
+    def is_done(self, *unit):
+        """
+        Return True if the unit is already completed.
+        """
+        return tuple(unit) in self.completed
+
+    def done(self, *unit, sync=True):
+        """
+        Record the unit as completed. With sync False the journal is only
+        flushed, and the caller syncs it to disk later.
+        """
+        unit = tuple(unit)
+        self.completed.add(unit)
+        self.fh.write(json.dumps(unit) + "\n")
+        if sync:
+            self.sync()
+        else:
+            self.fh.flush()
+
+    def record_start(self, starttime):
+        """
+        Return the start time of the experiment first recorded in the
+        journal, recording starttime if there is none yet.
+        """
+        if self.starttime is None:
+            self.starttime = starttime
+            self.fh.write(json.dumps(["starttime", starttime]) + "\n")
+            self.sync()
+        return self.starttime
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
@@ -0,0 +1,166 @@
+"""
+Live statistics of the probes of a running worker, served over HTTP
+in the Prometheus text format.
+
+Contains the following classes:
+ - metrics: counters and gauges updated by the probe loop
+ - metricshandler: HTTP handler serving /metrics
+
+The probe loop only updates plain counters and dictionary entries of the
+module-level registry, without locks. A scrape reads them in the server
+thread, so it never blocks the probes. Start the server on localhost with
+start_server(port), e.g. through "metricsPort" in the experiment config,
+and scrape it with:
+
+    curl http://127.0.0.1:9109/metrics
+"""
+
+import time
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "apperf"
+
+logger = logging.getLogger("apmetrics")
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class metrics:
+    """
+    Counters and gauges of the probe loop
+    """
+    def __init__(self):
+        self.starttime = time.time()
+        self.probes = 0
+        self.probe_failures = 0
+        # (srcip, dest, count, interval, pktsize) -> (avg rtt ms, loss percent, time of the probe)
+        self.pairs = {}
+        self.cmds = 0
+        self.cmd_spawn_seconds = 0.0
+        self.cmd_spawn_max = 0.0
+        self.cmd_seconds = 0.0
+        self.runs = 0
+        self.slip_last = 0.0
+        self.slip_max = 0.0
+        self.slip_seconds = 0.0
+
+    def observe_probe(self, srcip, dest, count, interval, pktsize, rtt, loss):
+        """
+        Record a probe with its average RTT in milliseconds and its loss in
+        percent. A failed probe has loss 100 and rtt None.
+        """
+        self.probes += 1
+        if rtt is None:
+            self.probe_failures += 1
+            old = self.pairs.get((srcip, dest, count, interval, pktsize))
+            rtt = old[0] if old is not None else None
+        self.pairs[(srcip, dest, count, interval, pktsize)] = (rtt, loss, time.time())
+
+    def observe_cmd(self, spawn, elapsed):
+        """
+        Record a run_cmd: the seconds to spawn the process, and in total
+        """
+        self.cmds += 1
+        self.cmd_spawn_seconds += spawn
+        self.cmd_seconds += elapsed
+        if spawn > self.cmd_spawn_max:
+            self.cmd_spawn_max = spawn
+
+    def observe_slip(self, slip):
+        """
+        Record how late in seconds a run started against its schedule
+        """
+        self.runs += 1
+        self.slip_last = slip
+        self.slip_seconds += slip
+        if slip > self.slip_max:
+            self.slip_max = slip
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format
+        """
+        uptime = time.time() - self.starttime
+        lines = []
+
+        def metric(name, mtype, help, samples):
+            lines.append("# HELP %s_%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s_%s %s" % (PREFIX, name, mtype))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                if labels:
+                    labels = "{%s}" % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+                lines.append("%s_%s%s %s" % (PREFIX, name, labels, repr(float(value))))
+
+        metric("uptime_seconds", "gauge", "Seconds since the worker started", [("", uptime)])
+        metric("probes_total", "counter", "Number of probes", [("", self.probes)])
+        metric("probe_failures_total", "counter", "Number of failed probes",
+               [("", self.probe_failures)])
+        metric("probes_per_second", "gauge", "Average probe rate since the worker started",
+               [("", self.probes / uptime if uptime > 0 else 0)])
+        # copy the items, the probe loop may add pairs while we read
+        pairs = sorted(list(self.pairs.items()), key=lambda item: tuple(str(k) for k in item[0]))
+        pairlabels = lambda key: (("src", key[0] or ""), ("dest", key[1]), ("count", key[2]),
+                                  ("interval", key[3]), ("pktsize", key[4]))
+        metric("rtt_milliseconds", "gauge", "Average RTT of the last successful probe of the pair",
+               [(pairlabels(key), value[0]) for key, value in pairs])
+        metric("loss_percent", "gauge", "Packet loss of the last probe of the pair",
+               [(pairlabels(key), value[1]) for key, value in pairs])
+        metric("last_probe_timestamp_seconds", "gauge", "Time of the last probe of the pair",
+               [(pairlabels(key), value[2]) for key, value in pairs])
+        metric("cmd_total", "counter", "Number of commands run", [("", self.cmds)])
+        metric("cmd_spawn_seconds_total", "counter", "Seconds spent spawning command processes",
+               [("", self.cmd_spawn_seconds)])
+        metric("cmd_spawn_seconds_max", "gauge", "Longest time to spawn a command process",
+               [("", self.cmd_spawn_max)])
+        metric("cmd_seconds_total", "counter", "Seconds spent running commands",
+               [("", self.cmd_seconds)])
+        metric("runs_total", "counter", "Number of runs started", [("", self.runs)])
+        metric("run_slip_seconds", "gauge", "How late the last run started against its schedule",
+               [("", self.slip_last)])
+        metric("run_slip_seconds_max", "gauge", "Largest lateness of a run against its schedule",
+               [("", self.slip_max)])
+        metric("run_slip_seconds_total", "counter", "Sum of the lateness of all runs",
+               [("", self.slip_seconds)])
+        return '\n'.join(lines) + '\n'
+
+
+registry = metrics()
+
+
+class metricshandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics of the registry on /metrics
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def start_server(port, addr="127.0.0.1"):
+    """
+    Serve the metrics on addr:port from a background thread.
+    Return the server.
+    """
+    server = ThreadingHTTPServer((addr, port), metricshandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="apmetrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics" % (addr, server.server_address[1]))
+    return server
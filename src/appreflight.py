@@ -0,0 +1,174 @@
+"""
+Contains the following class:
+ - preflight: checks the source interfaces and the reachability of the
+   destinations before a latency experiment
+
+The checks run in parallel, and their results are cached in a json file
+for ttl seconds, so that a restarted or repeated experiment does not
+check again. The latency experiment probes the unreachable destinations
+only every deadevery runs, instead of waiting for every ping to time out.
+"""
+
+import os
+import json
+import time
+import logging
+import concurrent.futures
+import apdelay
+from ap_utils import *
+
+# maximum number of checks running at the same time
+MAX_CHECKS = 64
+
+
+class preflight:
+    """
+    Reachability map of (srcip, destip) pairs, and the health of the
+    interfaces of the srcips, cached in cachefile. The destinations are
+    checked with the probe type of the experiment, ptype.
+    """
+    def __init__(self, cachefile, ttl=300, timeout=1, deadevery=10, ptype="ping"):
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self.timeout = timeout
+        self.ptype = ptype
+        self.deadevery = deadevery
+        self.logger = logging.getLogger("preflight")
+        # key -> {"ok": bool, "time": seconds since the epoch}
+        self.cache = {}
+        self.load()
+
+    def load(self):
+        """
+        Read the cache file, if any
+        """
+        if not os.path.exists(self.cachefile):
+            return
+        try:
+            with open(self.cachefile, 'r') as cf:
+                self.cache = json.load(cf)
+        except ValueError:
+            self.logger.warning("Ignoring corrupt preflight cache %s" % self.cachefile)
+            self.cache = {}
+
+    def save(self):
+        """
+        Write the cache file, replacing the old one atomically
+        """
+        tmpfile = self.cachefile + ".tmp"
+        with open(tmpfile, 'w') as cf:
+            json.dump(self.cache, cf)
+        os.replace(tmpfile, self.cachefile)
+
+    def cached(self, key):
+        """
+        Return the cached result of the check, or None if it expired
+        """
+        entry = self.cache.get(key)
+        if entry is None or time.time() - entry["time"] > self.ttl:
+            return None
+        return entry["ok"]
+
+    def record(self, key, ok):
+        self.cache[key] = {"ok": ok, "time": time.time()}
+
+    @staticmethod
+    def reach_key(srcip, destip):
+        return "%s %s" % (srcip, destip)
+
+    @staticmethod
+    def intf_key(srcip):
+        return "intf %s" % srcip
+
+    def check_src(self, srcip):
+        """
+        Check the interface of srcip, and cycle it only if it is not up.
+        Return True if the interface is healthy.
+        """
+        ok = self.cached(self.intf_key(srcip))
+        if ok is not None:
+            return ok
+        intf = get_intf(srcip)
+        if intf is None:
+            self.logger.error("No interface with IP address %s" % srcip)
+            return False
+        ok, output = intf_up(intf)
+        if not ok:
+            self.logger.warning("Interface %s of %s not healthy, cycling it" % (intf, srcip))
+            ret, log = cycle_interface(intf)
+            ok, output = intf_up(intf)
+        return ok
+
+    def check_dest(self, srcip, destip):
+        """
+        Ping destip once from srcip, return True if it is reachable
+        """
+        probe = apdelay.apdelay(destip, srcip=srcip, count=1, interval=None,
+                                pType=self.ptype, timeout=self.timeout)
+        ret, output = probe.ping()
+        return ret == 0
+
+    def check(self, srcips, destips):
+        """
+        Check all source interfaces, then all (srcip, destip) pairs not in
+        the cache, in parallel. Return the list of unreachable pairs.
+        """
+        if len(srcips) == 0:
+            srcips = [None]
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CHECKS) as executor:
+            checksrcs = [srcip for srcip in srcips if srcip is not None]
+            for srcip, ok in zip(checksrcs, executor.map(self.check_src, checksrcs)):
+                self.record(self.intf_key(srcip), ok)
+            pairs = [(srcip, destip) for srcip in srcips for destip in destips
+                     if self.cached(self.reach_key(srcip, destip)) is None]
+            results = executor.map(lambda pair: self.check_dest(*pair), pairs)
+            for (srcip, destip), ok in zip(pairs, results):
+                self.record(self.reach_key(srcip, destip), ok)
+        self.save()
+        dead = [(srcip, destip) for srcip in srcips for destip in destips
+                if not self.is_alive(srcip, destip)]
+        self.logger.info("Preflight checked %d pairs in %.2f seconds, %d unreachable" %
+                         (len(pairs), time.time() - start, len(dead)))
+        for srcip, destip in dead:
+            self.logger.warning("Unreachable: %s from %s, probing every %d runs" %
+                                (destip, srcip, self.deadevery))
+        return dead
+
+    def is_alive(self, srcip, destip):
+        """
+        Return False if destip was found unreachable from srcip,
+        or the interface of srcip is not healthy
+        """
+        if srcip is not None and self.cache.get(self.intf_key(srcip), {}).get("ok") is False:
+            return False
+        return self.cache.get(self.reach_key(srcip, destip), {}).get("ok", True)
+
+    def should_probe(self, srcip, destip, runid):
+        """
+        Return True if the pair is to be probed in this run: always if it
+        is reachable, otherwise only every deadevery runs.
+        """
+        if self.is_alive(srcip, destip):
+            return True
+        return self.deadevery > 0 and runid % self.deadevery == 0
+
+    def update(self, srcip, destip, ok):
+        """
+        Update the reachability of the pair with the result of a probe.
+        A successful probe also shows that the interface of srcip is healthy.
+        """
+        changed = False
+        key = self.reach_key(srcip, destip)
+        if self.cache.get(key, {}).get("ok") != ok:
+            self.logger.warning("%s from %s is now %s" %
+                                (destip, srcip, "reachable" if ok else "unreachable"))
+            self.record(key, ok)
+            changed = True
+        key = self.intf_key(srcip)
+        if ok and srcip is not None and self.cache.get(key, {}).get("ok") is False:
+            self.logger.warning("Interface of %s is healthy again" % srcip)
+            self.record(key, True)
+            changed = True
+        if changed:
+            self.save()
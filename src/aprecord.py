@@ -0,0 +1,113 @@
+"""
+Contains the following class:
+ - latrecord: compact record for one run of a latency experiment
+
+The latency experiments keep every run in memory and write it to csv,
+so the record uses __slots__ with typed numeric fields instead of a dict
+of strings, and interns the host and IP strings shared by all records.
+"""
+
+import sys
+import math
+import pingparser
+
+NaN = float('nan')
+
+
+class latrecord:
+    """
+    Result of one ping run from srcip to dest.
+    FIELDS is the order of the csv columns.
+    """
+    FIELDS = ('expid', 'hostname', 'srcip', 'dest', 'interval',
+              'pktsize', 'runid', 'sent', 'received', 'packet_loss',
+              'minping', 'avgping', 'maxping', 'jitter', 'timestamp', 'slip',
+              'count', 'tsdelta', 'txfallback')
+    __slots__ = FIELDS
+
+    def __init__(self, expid, hostname, srcip, dest, interval, pktsize, runid,
+                 sent=0, received=0, packet_loss=NaN, minping=NaN,
+                 avgping=NaN, maxping=NaN, jitter=NaN, timestamp=NaN, slip=NaN,
+                 count=None, tsdelta=NaN, txfallback=None):
+        self.expid = expid
+        self.hostname = intern_str(hostname)
+        self.srcip = intern_str(srcip)
+        self.dest = intern_str(dest)
+        self.interval = interval
+        self.pktsize = pktsize
+        self.runid = runid
+        self.sent = sent
+        self.received = received
+        self.packet_loss = packet_loss
+        self.minping = minping
+        self.avgping = avgping
+        self.maxping = maxping
+        self.jitter = jitter
+        self.timestamp = timestamp
+        self.slip = slip
+        self.count = count
+        self.tsdelta = tsdelta
+        self.txfallback = txfallback
+
+    @classmethod
+    def from_ping(cls, ping_output, expid, hostname, srcip, interval, pktsize, runid,
+                  timestamp=NaN, slip=NaN, count=None, tsdelta=NaN, txfallback=None):
+        """
+        Parse the output of the system ping command into a record.
+        The timestamp is the start time of the ping in seconds since the epoch,
+        the slip is how late the run started against its schedule in seconds,
+        the count is the number of pings requested, tsdelta is the mean
+        difference in milliseconds between the userspace and kernel RTTs, and
+        txfallback is the number of replies timed from the userspace send time
+        for lack of a kernel send timestamp.
+        Raises Exception for invalid ping output, like pingparser.parse
+        """
+        values = pingparser.parse_values(ping_output)
+        return cls(expid, hostname, srcip, values['dest'], interval, pktsize, runid,
+                   values['sent'], values['received'], values['packet_loss'],
+                   values['minping'], values['avgping'], values['maxping'], values['jitter'],
+                   timestamp, slip, count, tsdelta, txfallback)
+
+    def values(self):
+        """
+        Return the record as a tuple in FIELDS order
+        """
+        return (self.expid, self.hostname, self.srcip, self.dest, self.interval,
+                self.pktsize, self.runid, self.sent, self.received, self.packet_loss,
+                self.minping, self.avgping, self.maxping, self.jitter, self.timestamp,
+                self.slip, self.count, self.tsdelta, self.txfallback)
+
+    def as_row(self):
+        """
+        Return the record as a tuple in FIELDS order, for csv.writer.
+        Missing values are written as NaN, as pingparser.parse returns them.
+        """
+        return tuple(csv_value(value) for value in self.values())
+
+    def as_dict(self):
+        """
+        Return the record as a dictionary, keyed by FIELDS
+        """
+        return dict(zip(self.FIELDS, self.values()))
+
+    def __repr__(self):
+        return "latrecord(%s)" % ', '.join("%s=%r" % item for item in self.as_dict().items())
+
+
+def csv_value(value):
+    """
+    Return value for a csv file, with NaN spelled as in the ping results
+    """
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return value
+
+
+def intern_str(s):
+    """
+    Intern the string s, so that all records share one copy of it.
+    None is returned as is.
+    """
+    if s is None:
+        return None
+    return sys.intern(str(s))
@@ -0,0 +1,89 @@
+"""
+Contains the following class:
+ - runclock: schedules the runs of an experiment
+
+With a run slot, run r starts at starttime + r * slot on a monotonic
+clock, so the runs do not drift, and workers given the same start time
+by the master take their runs at the same time. A resumed experiment
+keeps the grid of its original start time: its first remaining run
+starts at the first slot of that grid after the new start time, instead
+of waiting for the slots of the runs already completed. Without a run
+slot, each run starts runinterval seconds after the previous one finished.
+"""
+
+import math
+import time
+import logging
+import apmetrics
+
+# sleep until this close to a deadline, then spin
+SPIN_SECONDS = 0.001
+
+
+def sleep_until(deadline):
+    """
+    Sleep until the time.monotonic() deadline.
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if remaining > SPIN_SECONDS:
+            time.sleep(remaining - SPIN_SECONDS)
+
+
+class runclock:
+    """
+    Run schedule of an experiment. starttime is in seconds since the
+    epoch, default now, and epoch is the start time of the slot grid,
+    default starttime. wait(runid) blocks until the run is due and
+    returns the slip: how late in seconds the run started.
+    """
+    def __init__(self, starttime=None, slot=None, runinterval=0, epoch=None):
+        self.starttime = starttime if starttime is not None else time.time()
+        self.slot = slot
+        self.runinterval = runinterval
+        self.epoch = epoch
+        # monotonic time of run 0 on the slot grid, set by the first run
+        self.gridstart = None
+        self.logger = logging.getLogger("apsched")
+        # map the wall clock start time on the monotonic clock once
+        self.monostart = time.monotonic() + (self.starttime - time.time())
+        self.deadline = None
+
+    def run_deadline(self, runid):
+        """
+        Return the monotonic time at which the run is due.
+        """
+        if self.slot:
+            if self.gridstart is None:
+                self.gridstart = self.grid_start(runid)
+            return self.gridstart + runid * self.slot
+        if self.deadline is None:
+            return self.monostart
+        return time.monotonic() + self.runinterval
+
+    def grid_start(self, firstrun):
+        """
+        Return the monotonic time of run 0 on the slot grid, such that
+        firstrun is due at the first slot at or after the start time.
+        """
+        epoch = self.epoch if self.epoch is not None else self.starttime
+        slots = max(math.ceil((self.starttime - epoch) / self.slot - 1e-9), 0)
+        return self.monostart + (epoch - self.starttime) + (slots - firstrun) * self.slot
+
+    def wait(self, runid):
+        """
+        Wait for the start of the run, and return its slip in seconds.
+        """
+        self.deadline = self.run_deadline(runid)
+        if self.deadline > time.monotonic():
+            self.logger.debug("Run %d: waiting %.3f seconds", runid,
+                              self.deadline - time.monotonic())
+        sleep_until(self.deadline)
+        slip = time.monotonic() - self.deadline
+        apmetrics.registry.observe_slip(slip)
+        if self.slot and slip > self.slot:
+            self.logger.warning("Run %d: started %.3f seconds late, runs overrun the slot of %s seconds",
+                                runid, slip, self.slot)
+        return slip
@@ -15,6 +15,8 @@ import re
 import sys
 
 __all__ = ["parse",
+           "parse_values",
+           "parse_rtts",
            "format_ping_result",
            ]
 
@@ -36,6 +38,9 @@ rslt_matcher = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?receiv
 # Pull out round-trip min/avg/max/stddev = 49.042/49.042/49.042/0.000 ms
 minmax_matcher = re.compile(r'(\d+.\d+)/(\d+.\d+)/(\d+.\d+)/(\d+.\d+)')
 
+# Pull out the round trip time of each reply: ... icmp_seq=1 ttl=64 time=0.412 ms
+rtt_matcher = re.compile(r'icmp_seq=\d+ .*time=(\d+\.?\d*) ms')
+
 # Available replacements
 format_replacements = [('%h', 'host'),
                        ('%s', 'sent'),
@@ -97,6 +102,30 @@ def parse(ping_output):
             }
 
 
+def parse_values(ping_output):
+    """
+    Parse `ping_output` like `parse`, but return the fields as numbers:
+    `sent` and `received` as *int*, the other fields except `dest` as
+    *float*, with float('nan') for the round trip times if no reply was
+    received.
+    """
+    result = parse(ping_output)
+    values = {'dest': result['dest'],
+              'sent': int(result['sent']),
+              'received': int(result['received'])}
+    for field in ('packet_loss', 'minping', 'avgping', 'maxping', 'jitter'):
+        values[field] = float(result[field])
+    return values
+
+
+def parse_rtts(ping_output):
+    """
+    Return the list of round trip times in milliseconds, as *float*, of
+    the replies in `ping_output`.
+    """
+    return [float(rtt) for rtt in rtt_matcher.findall(ping_output)]
+
+
 def format_ping_result(ping_result, format_string=default_format):
     """Use format_string to format the ping_result dictionary."""
     output = format_string
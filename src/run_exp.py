@@ -12,14 +12,33 @@ import argparse
 import os
 import sys
 import json
+import gzip
+import queue
+import atexit
+import time
 import concurrent.futures
 import logging
 import logging.handlers
 from datetime import datetime
 import apexp
+import apjournal
+import apmetrics
 from ap_utils import *
 
 logger = logging.getLogger('')
+# raw output of the probes, optionally logged to a separate compressed file
+probelogger = logging.getLogger('probe')
+
+# default size based rotation of the log file, rotated files are compressed
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# seconds between flushes of the compressed probe output file
+PROBE_FLUSH_SECONDS = 5
+
+log_listeners = []
+
+# seconds from dispatching the experiment to its start on the remote nodes
+START_DELAY = 15
 
 def get_logdir(config, role):
     logdir = config["logDir"]
@@ -33,10 +52,102 @@ def get_filenames(expid, exptype, logdir):
     logfile = os.path.join(logdir, lfn)
     cfn = "results_%s_%s_%d_%s.csv" % (myname, exptype, expid, ts)
     csvfile = os.path.join(logdir, cfn)
-    return logfile, csvfile
+    pfn = "probe_%s_%s_%d_%s.txt.gz" % (myname, exptype, expid, ts)
+    probefile = os.path.join(logdir, pfn)
+    return logfile, csvfile, probefile
+
+
+def get_journalfile(expid, exptype, logdir, role="worker"):
+    """
+    Return the journal file for the experiment. Unlike the log and csv
+    files it has no timestamp, so that a restarted experiment finds it.
+    """
+    myname = get_hostname()
+    jfn = "journal_%s_%s_%d.txt" % (myname, exptype, expid)
+    if role == "master":
+        jfn = "journal_%s_%s_%d_master.txt" % (myname, exptype, expid)
+    return os.path.join(logdir, jfn)
+
+
+class deferredqueuehandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the record to the
+    handlers of the listener thread, off the probe hot path.
+    The queue is in-process, so the record does not need pickling.
+    """
+    def prepare(self, record):
+        return record
+
+
+class gziphandler(logging.StreamHandler):
+    """
+    Write records to a gzip compressed file. A flush of a gzip file ends
+    the compressed block, so the file is flushed at most every
+    flushinterval seconds instead of after every record, and on close.
+    """
+    def __init__(self, filename, flushinterval=PROBE_FLUSH_SECONDS):
+        super().__init__(gzip.open(filename, 'at'))
+        self.flushinterval = flushinterval
+        self.lastflush = time.monotonic()
+
+    def flush(self):
+        now = time.monotonic()
+        if now - self.lastflush >= self.flushinterval:
+            self.lastflush = now
+            super().flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+def gzip_rotator(source, dest):
+    """
+    Compress the rotated log file
+    """
+    with open(source, 'rb') as sf, gzip.open(dest, 'wb') as df:
+        df.writelines(sf)
+    os.remove(source)
+
+
+def start_listener(target, *handlers):
+    """
+    Attach a queue handler to the target logger, and start a background
+    thread writing the queued records to the given handlers.
+    """
+    q = queue.SimpleQueue()
+    target.addHandler(deferredqueuehandler(q))
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    log_listeners.append((listener, handlers))
+
 
+def stop_logging():
+    """
+    Write out the queued log records and close the log files.
+    """
+    while log_listeners:
+        listener, handlers = log_listeners.pop()
+        listener.stop()
+        for handler in handlers:
+            handler.close()
 
-def init_logging(logfile, verbose):
+
+def init_logging(logfile, verbose, maxbytes=LOG_MAX_BYTES, backups=LOG_BACKUP_COUNT,
+                 probefile=None):
+    """
+    Log to console at the verbose level, and to the logfile at DEBUG level.
+    The records are queued and written by a background thread, the logfile
+    is rotated every maxbytes and the rotated files are compressed.
+    If probefile is given, the raw probe output is written to it with gzip
+    compression instead of to the logfile.
+    """
     ## config console logging with default level INFO
     ch = logging.StreamHandler(sys.stdout)
     if verbose.lower() == "debug":
@@ -50,17 +161,27 @@ def init_logging(logfile, verbose):
 
     formatter = logging.Formatter('[%(name)s] %(levelname)s: %(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
 
     ## config file logging
-    fh = logging.FileHandler(logfile)
+    fh = logging.handlers.RotatingFileHandler(logfile, maxBytes=maxbytes, backupCount=backups)
+    fh.namer = lambda name: name + ".gz"
+    fh.rotator = gzip_rotator
     fh.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s - [%(name)s] %(levelname)-8s: %(message)s')
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    start_listener(logger, ch, fh)
     logger.propagate = 0
     logger.setLevel(logging.DEBUG)
 
+    ## config raw probe output logging
+    if probefile is not None:
+        ph = gziphandler(probefile)
+        ph.setLevel(logging.DEBUG)
+        ph.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        start_listener(probelogger, ph)
+        probelogger.propagate = 0
+    atexit.register(stop_logging)
+
     return logger
 
 
@@ -77,21 +198,28 @@ def sync_from_client(remote_user, remote_ip, remote_dir, local_dir, ssh_key=None
         logger.info("Success: sync from %s complete", remote_ip)
     else:
         logger.error("Fail: sync from %s could not be completed", remote_ip)
+    return ret
 
 
-def run_one_remote_exp(remote_ip, config):
+def get_ssh_opts(config):
     """
-    Run the same experiment on a remote node
+    Return the ssh options and the ssh key for the remote nodes
     """
-    remote_user = config["remoteUser"]
-    gitdir = config["gitDir"]
-    remoteConfFile = config["remoteConfFile"]
     ssh_opts = "-o ConnectTimeout=10 -o StrictHostKeyChecking=no"
     if "sshKey" in config:
         ssh_key = config["sshKey"]
         ssh_opts = ssh_opts + " -i %s" % (ssh_key)
     else:
         ssh_key = ""
+    return ssh_opts, ssh_key
+
+
+def prepare_remote_node(remote_ip, config):
+    """
+    Prepare a remote node for the experiment by cloning or updating the git repo
+    """
+    remote_user = config["remoteUser"]
+    ssh_opts, ssh_key = get_ssh_opts(config)
     # prepare each node using local script
     gitmasterdir = config["gitMasterDir"]
     gitbase = os.path.basename(os.path.normpath(gitmasterdir))
@@ -105,9 +233,22 @@ def run_one_remote_exp(remote_ip, config):
                                                                                gitroot, gitbase,
                                                                                ssh_key, git_remote)
     ret, output = run_cmd(cmd)
+    return ret
+
+
+def run_one_remote_exp(remote_ip, config, starttime=None):
+    """
+    Run the same experiment on a remote node, starting at starttime
+    """
+    remote_user = config["remoteUser"]
+    gitdir = config["gitDir"]
+    remoteConfFile = config["remoteConfFile"]
+    ssh_opts, ssh_key = get_ssh_opts(config)
     # in each thread start the experiment locally
     remote_cmd = "%s -l worker %s" % (os.path.join(gitdir, "src/run_exp.py"),
                                       os.path.join(gitdir, remoteConfFile))
+    if starttime is not None:
+        remote_cmd = remote_cmd + " -s %.6f" % starttime
     cmd = "ssh %s %s@%s \"%s\"" % (ssh_opts, remote_user, remote_ip, remote_cmd)
     logger.info("Node %s: sending run experiment command: \"%s\"" % (remote_ip, cmd))
     ret, output = run_cmd(cmd)
@@ -116,20 +257,38 @@ def run_one_remote_exp(remote_ip, config):
     # at the end sync remote logs and results to the master
     local_logdir = get_logdir(config, "master")
     remote_dir = get_logdir(config, "worker")
-    sync_from_client(remote_user, remote_ip, remote_dir, local_logdir, ssh_key)
-    return 0
+    sync_ret = sync_from_client(remote_user, remote_ip, remote_dir, local_logdir, ssh_key)
+    if ret == 0:
+        ret = sync_ret
+    return ret
 
 
-def run_remote_exp(config):
+def run_remote_exp(config, journal=None):
     """
-    Run the experiment on a remote client through ssh
+    Run the experiment on a remote client through ssh.
+    Nodes recorded as complete in the journal are skipped.
     """
     logger.info("Preparing remote experiments")
     nodes = config["nodes"]
-    # start a thread for each remote node
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    if journal is not None:
+        journal.open(get_logdir(config, "master"))
+        done = [node for node in nodes if journal.is_done(node)]
+        if len(done) > 0:
+            logger.warning("Skipping nodes that already completed the experiment: %s" %
+                           ", ".join(done))
+        nodes = [node for node in nodes if not journal.is_done(node)]
+    if len(nodes) == 0:
+        return
+    # start a thread for each remote node, all nodes run concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        # prepare all nodes before handing out the start time
+        list(executor.map(lambda node: prepare_remote_node(node, config), nodes))
+        starttime = time.time() + config.get("startDelay", START_DELAY)
+        logger.info("Experiment starts on all nodes at %s" %
+                    datetime.fromtimestamp(starttime).strftime("%Y-%m-%d %H:%M:%S.%f"))
         # create a dict of future to the node
-        future_to_node = {executor.submit(run_one_remote_exp, node, config): node for node in nodes}
+        future_to_node = {executor.submit(run_one_remote_exp, node, config, starttime): node
+                          for node in nodes}
         for future in concurrent.futures.as_completed(future_to_node):
             node = future_to_node[future]
             try:
@@ -137,7 +296,12 @@ def run_remote_exp(config):
             except Exception as e:
                 logger.error("Node %s: generated exception: %s" % (node, e))
             else:
+                if ret != 0:
+                    logger.error("Node %s: experiment incomplete" % node)
+                    continue
                 logger.info("Node %s: experiment complete" % node)
+                if journal is not None:
+                    journal.done(node)
 
 
 def main():
@@ -152,6 +316,8 @@ def main():
         --conffile, -c: the configuration or parameters for the experiments,
                         which may be superseded by the CLI arguments above
         --verbose, -v: verbose/debug output
+        --starttime, -s: the start time of the experiment in seconds since
+                         the epoch, handed out by the master to all workers
     """
     parser = argparse.ArgumentParser()
     # parser.add_argument("-r", "--runs", type=int, default=50,
@@ -168,6 +334,8 @@ def main():
                         help="role for this host: master|worker")
     parser.add_argument("-m", "--masterip",
                         help="ip address of the master if the role is remote client")
+    parser.add_argument("-s", "--starttime", type=float,
+                        help="start time of the experiment in seconds since the epoch, given by the master")
     parser.add_argument("conffile",
                         help="the configuration for the experiments, may be superseded by CLI args")
     args = parser.parse_args()
@@ -184,23 +352,44 @@ def main():
 
     print("Creating log directory if it doesn't exist: %s" % logdir)
     ret, output = run_cmd("mkdir -p %s" % logdir)
-    logfile, csvfile = get_filenames(expid, exptype, logdir)
+    logfile, csvfile, probefile = get_filenames(expid, exptype, logdir)
     print("Logging to file: %s" % logfile)
-    logger = init_logging(logfile, "info")
+    if not config.get("rawProbeLog", False):
+        probefile = None
+    logger = init_logging(logfile, "info",
+                          maxbytes=config.get("logMaxBytes", LOG_MAX_BYTES),
+                          backups=config.get("logBackupCount", LOG_BACKUP_COUNT),
+                          probefile=probefile)
 
     print("Prepare experiment")
     logger.info("Prepare experiment")
 
+    # a journal of an earlier run of this experiment means it is resumed
+    journal = apjournal.journal(get_journalfile(expid, exptype, logdir, role))
+    if journal.resuming():
+        print("Resuming experiment from journal %s" % journal.path)
+        logger.info("Resuming experiment from journal %s" % journal.path)
+
     if role == "master":
         print("Start remote experiment")
-        run_remote_exp(config)
+        run_remote_exp(config, journal)
         print("End remote experiment")
     else:
-        exp = apexp.experiment(expid, logdir, config, csvfile, nruns=nruns, exptype=exptype)
+        if "metricsPort" in config:
+            # the metrics are optional, the experiment runs without them
+            try:
+                apmetrics.start_server(config["metricsPort"], config.get("metricsAddr", "127.0.0.1"))
+            except (OSError, OverflowError, TypeError) as e:
+                logger.error("Could not serve metrics on %s:%s, continuing without them: %s" %
+                             (config.get("metricsAddr", "127.0.0.1"), config["metricsPort"], e))
+        exp = apexp.experiment(expid, logdir, config, csvfile, nruns=nruns, exptype=exptype,
+                               journal=journal, starttime=args.starttime)
         print("Start experiment")
         logger.info("Start experiment")
         exp.start()
         logger.info("End experiment")
+    journal.close()
+    stop_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+
+"""
+Scale test harness: simulates a cluster of N worker nodes on one Linux host
+and runs a latency experiment end to end in the master mode against them.
+
+The master runs unmodified, with stand-in ssh and rsync executables first
+in its PATH. The ssh stand-in runs the remote command locally as the
+simulated node: in its own UTS namespace with the node's hostname, with its
+own log directory, and, in the netns mode, in the node's network namespace.
+The rsync stand-in copies the node's log directory to the master.
+
+Two modes are supported:
+ - stub: stand-in ping, hostname and ip executables answer for the nodes,
+   with a fixed simulated RTT. Needs only unshare, and runs as any user
+   allowed to create user namespaces.
+ - netns: every node gets a network namespace on a common bridge, with netem
+   delay and loss on its link. The probes are real, by default with the
+   kernel timestamped ping of apicmp, so the ping binary is not needed.
+   Needs root.
+
+For each N the harness reports the orchestration wall time of the master,
+its CPU time and peak memory, and the completeness of the results synced
+to the master. For example:
+
+    src/scale_sim.py -n 10 100 300 --runs 2
+    sudo src/scale_sim.py -n 50 --mode netns --delay 2 --loss 1
+"""
+import argparse
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+GITDIR = os.path.dirname(SRCDIR)
+# placeholder for the config path in the remote command, replaced per node by the ssh stand-in
+SIMCONF = "SIMCONF.json"
+BRIDGE = "apsimbr0"
+
+SSH_STANDIN = """#!/bin/sh
+# stand-in for ssh: run the remote command locally as the simulated node
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o|-i|-p|-l|-F) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+ip="${1#*@}"
+shift
+cmd="$*"
+case "$cmd" in
+    "bash -s"*)
+        # prepare_worker.sh on stdin, nothing to prepare
+        cat > /dev/null
+        exit 0;;
+esac
+node="$SIM_DIR/nodes/$ip"
+cmd=$(echo "$cmd" | sed "s#[^ ]*/%(simconf)s#$node/conf.json#")
+export SIM_NODE_IP="$ip"
+exec %(netns)s %(unshare)s sh -c "%(hostname)s sim-$(echo $ip | tr . -) && exec %(python)s $cmd"
+"""
+
+RSYNC_STANDIN = """#!/bin/sh
+# stand-in for rsync: copy the log directory of the simulated node to the master
+for arg in "$@"; do
+    src="$dest"
+    dest="$arg"
+done
+ip="${src#*@}"
+ip="${ip%%:*}"
+remote_dir="${src#*:}"
+mkdir -p "$dest/$(basename "$remote_dir")"
+cp -a "$SIM_DIR/nodes/$ip/logs/." "$dest/$(basename "$remote_dir")/"
+"""
+
+PING_STANDIN = """#!/bin/sh
+# stand-in for ping: answer with the simulated rtt and loss of the node
+count=1
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -c) count="$2"; shift 2;;
+        -c*) count="${1#-c}"; shift;;
+        -[iIWsw]) shift 2;;
+        -*) shift;;
+        *) host="$1"; shift;;
+    esac
+done
+awk -v host="$host" -v count="$count" -v rtt="$SIM_DELAY_MS" -v loss="$SIM_LOSS" \
+    -v pid="$$" -v node="$SIM_NODE_IP" 'BEGIN {
+    # seed per process and node, srand() alone seeds with the time in seconds
+    split(node, octets, ".");
+    srand((octets[3] * 256 + octets[4]) * 4194304 + pid);
+    printf "PING %%s (%%s) 56(84) bytes of data.\\n", host, host;
+    received = 0; sum = 0; sum2 = 0; min = -1; max = 0;
+    for (seq = 1; seq <= count; seq++) {
+        if (rand() * 100 < loss) continue;
+        t = rtt * (0.9 + 0.2 * rand());
+        printf "64 bytes from %%s: icmp_seq=%%d ttl=64 time=%%.3f ms\\n", host, seq, t;
+        received++; sum += t; sum2 += t * t;
+        if (min < 0 || t < min) min = t;
+        if (t > max) max = t;
+    }
+    printf "\\n--- %%s ping statistics ---\\n", host;
+    printf "%%d packets transmitted, %%d received, %%d%%%% packet loss, time 0ms\\n", count, received, 100 * (count - received) / count;
+    if (received > 0) {
+        avg = sum / received; mdev = sqrt(sum2 / received - avg * avg);
+        printf "rtt min/avg/max/mdev = %%.3f/%%.3f/%%.3f/%%.3f ms\\n", min, avg, max, mdev;
+    }
+    exit (received > 0 ? 0 : 1);
+}'
+"""
+
+HOSTNAME_STANDIN = """#!/bin/sh
+# stand-in for hostname: the IP address of the simulated node
+if [ "$1" = "-I" ]; then
+    echo "$SIM_NODE_IP "
+else
+    exec %(hostname)s "$@"
+fi
+"""
+
+IP_STANDIN = """#!/bin/sh
+# stand-in for ip: a healthy interface with the IP address of the simulated node
+echo "2: sim0    inet $SIM_NODE_IP/16 brd 10.77.255.255 scope global sim0 <UP>"
+"""
+
+
+def node_ips(n):
+    """
+    Return the IP addresses of n simulated nodes, in 10.77.0.0/16
+    """
+    return ["10.77.%d.%d" % (i // 250, i % 250 + 1) for i in range(n)]
+
+
+def netns_name(ip):
+    return "apsim-" + ip.replace('.', '-')
+
+
+def run(command, check=True, input=None):
+    res = subprocess.run(command, shell=True, universal_newlines=True, input=input,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if check and res.returncode != 0:
+        raise Exception("Failed: %s\n%s" % (command, res.stdout))
+    return res.stdout
+
+
+def run_batch(command, cmds):
+    """
+    Run the commands in one batch of ip or tc, given on stdin
+    """
+    return run(command + " -", input='\n'.join(cmds) + '\n')
+
+
+def setup_netns(ips, delay, loss):
+    """
+    Create a network namespace per node, linked to a bridge, with netem
+    delay in ms and loss in percent on the bridge side of every link.
+    Each direction gets the delay, so the RTT is twice the delay.
+    """
+    cmds = ["link add %s type bridge" % BRIDGE, "link set %s up" % BRIDGE]
+    for i, ip in enumerate(ips):
+        ns, veth = netns_name(ip), "apsim%d" % i
+        cmds += ["netns add %s" % ns,
+                 "link add %s type veth peer name eth0 netns %s" % (veth, ns),
+                 "link set %s master %s up" % (veth, BRIDGE)]
+    run_batch("ip -force -batch", cmds)
+    for ip in ips:
+        run_batch("ip -n %s -force -batch" % netns_name(ip),
+                  ["address add %s/16 dev eth0" % ip, "link set eth0 up", "link set lo up"])
+    netem = "delay %.3fms" % delay
+    if loss > 0:
+        netem += " loss %g%%" % loss
+    try:
+        run_batch("tc -force -batch", ["qdisc add dev apsim%d root netem %s" % (i, netem)
+                                       for i in range(len(ips))])
+    except Exception as e:
+        # e.g. the sch_netem module is not available
+        print("  Could not add netem, the links have no added delay or loss:\n%s" % e)
+
+
+def teardown_netns(ips):
+    for ip in ips:
+        run("ip netns delete %s" % netns_name(ip), check=False)
+    run("ip link delete %s" % BRIDGE, check=False)
+
+
+def write_standins(simdir, args):
+    """
+    Write the stand-in executables to simdir/bin
+    """
+    bindir = os.path.join(simdir, "bin")
+    os.makedirs(bindir)
+    if os.geteuid() == 0:
+        unshare = "unshare --uts"
+    else:
+        unshare = "unshare --uts --map-root-user"
+    subst = {"simconf": SIMCONF, "unshare": unshare, "python": sys.executable,
+             "hostname": shutil.which("hostname") or "/bin/hostname",
+             "netns": 'ip netns exec apsim-$(echo $ip | tr . -)' if args.mode == "netns" else ""}
+    standins = {"ssh": SSH_STANDIN % subst, "rsync": RSYNC_STANDIN}
+    if args.mode == "stub":
+        standins.update({"ping": PING_STANDIN % {}, "hostname": HOSTNAME_STANDIN % subst,
+                         "ip": IP_STANDIN})
+    for name, script in standins.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bindir
+
+
+def write_configs(simdir, ips, args):
+    """
+    Write the config of the master, and of each simulated node with its own log directory
+    """
+    config = {"expID": 36, "expType": "latency", "numRuns": args.runs,
+              "logDir": os.path.join(simdir, "logs"), "verbose": "WARNING",
+              "pingRepeat": args.repeat, "pingInterval": args.interval, "runInterval": 0,
+              "pktSizes": [64], "role": "worker", "nodes": ips,
+              "pairwiseNoDuplication": args.nodup, "remoteUser": "sim",
+              "remoteConfFile": SIMCONF, "gitMasterDir": GITDIR, "gitDir": GITDIR,
+              "startDelay": args.start_delay, "preflight": args.preflight,
+              "pingMode": args.ping_mode, "pingTimeout": 1}
+    if args.slot:
+        config["runSlot"] = args.slot
+    masterconf = os.path.join(simdir, "master.json")
+    with open(masterconf, 'w') as f:
+        json.dump(config, f, indent=1)
+    for ip in ips:
+        nodedir = os.path.join(simdir, "nodes", ip)
+        os.makedirs(os.path.join(nodedir, "logs"))
+        nodeconf = dict(config, logDir=os.path.join(nodedir, "logs"))
+        with open(os.path.join(nodedir, "conf.json"), 'w') as f:
+            json.dump(nodeconf, f)
+    return masterconf
+
+
+def proc_usage(pid):
+    """
+    Return the CPU seconds and the peak resident memory in bytes of the
+    process itself, excluding its children, or None if it has exited.
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open("/proc/%d/status" % pid) as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except (OSError, IndexError):
+        return None
+    if "VmHWM" not in status:
+        # a zombie has no memory left
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, int(status["VmHWM"].split()[0]) * 1024
+
+
+def run_master(simdir, masterconf, bindir, args):
+    """
+    Run the experiment in the master mode, sampling its resource usage.
+    Return the wall time, CPU seconds and peak memory of the master.
+    """
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ["PATH"], SIM_DIR=simdir,
+               SIM_DELAY_MS=str(2 * args.delay), SIM_LOSS=str(args.loss))
+    logfile = open(os.path.join(simdir, "master.out"), 'w')
+    start = time.monotonic()
+    proc = subprocess.Popen([sys.executable, os.path.join(SRCDIR, "run_exp.py"),
+                             masterconf, "-l", "master"], env=env, stdout=logfile,
+                            stderr=subprocess.STDOUT, start_new_session=True)
+    usage = (0.0, 0)
+    while proc.poll() is None:
+        sample = proc_usage(proc.pid)
+        if sample is not None:
+            usage = sample
+        if time.monotonic() - start > args.timeout:
+            print("  master timed out after %d seconds, killing it" % args.timeout)
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            break
+        time.sleep(0.1)
+    wall = time.monotonic() - start
+    logfile.close()
+    # kill any worker left behind
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    return wall, usage[0], usage[1]
+
+
+def check_results(simdir, ips, args):
+    """
+    Return the number of result rows synced to the master, the number
+    expected, the number of nodes with complete results, the number of
+    nodes recorded complete in the master journal, and the largest slip.
+    """
+    per_node = {ip: 0 for ip in ips}
+    maxslip = 0.0
+    for path in glob.glob(os.path.join(simdir, "logs", "**", "results_*.csv"), recursive=True):
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                if row["srcip"] in per_node:
+                    per_node[row["srcip"]] += 1
+                try:
+                    maxslip = max(maxslip, float(row["slip"]))
+                except (KeyError, ValueError):
+                    pass
+    expected_node = {}
+    for ip in ips:
+        dests = [d for d in ips if d != ip]
+        if args.nodup:
+            dests = [d for d in dests if d > ip]
+        expected_node[ip] = len(dests) * args.runs
+    complete = sum(1 for ip in ips if per_node[ip] >= expected_node[ip])
+    journaled = 0
+    for path in glob.glob(os.path.join(simdir, "logs", "journal_*_master.txt")):
+        with open(path) as f:
+            journaled += max(len(f.readlines()) - 1, 0)
+    return (sum(per_node.values()), sum(expected_node.values()), complete, journaled, maxslip)
+
+
+def simulate(n, args):
+    """
+    Simulate a cluster of n nodes, and return its report
+    """
+    simdir = os.path.join(args.workdir, "n%d" % n)
+    if os.path.exists(simdir):
+        shutil.rmtree(simdir)
+    os.makedirs(os.path.join(simdir, "logs"))
+    ips = node_ips(n)
+    bindir = write_standins(simdir, args)
+    masterconf = write_configs(simdir, ips, args)
+    try:
+        if args.mode == "netns":
+            teardown_netns(ips)
+            setup_netns(ips, args.delay, args.loss)
+        wall, cpu, mem = run_master(simdir, masterconf, bindir, args)
+    finally:
+        if args.mode == "netns":
+            teardown_netns(ips)
+    rows, expected, complete, journaled, maxslip = check_results(simdir, ips, args)
+    return {"nodes": n, "wall_s": wall, "master_cpu_s": cpu, "master_peak_mb": mem / 2 ** 20,
+            "rows": rows, "expected_rows": expected, "nodes_complete": complete,
+            "nodes_journaled": journaled, "max_slip_s": maxslip}
+
+
+def main():
+    """
+    Run the scale test for each number of nodes
+    Arguments:
+        --nodes, -n: the numbers of simulated nodes
+        --mode: stub or netns
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--nodes", type=int, nargs="+", default=[10, 50, 100],
+                        help="the numbers of nodes to simulate")
+    parser.add_argument("--mode", default="stub", choices=["stub", "netns"],
+                        help="stand-in ping, or network namespaces with netem (needs root)")
+    parser.add_argument("-r", "--runs", type=int, default=1, help="numRuns of the experiment")
+    parser.add_argument("--repeat", type=int, default=2, help="pingRepeat of the experiment")
+    parser.add_argument("--interval", type=float, default=0.01,
+                        help="pingInterval of the experiment")
+    parser.add_argument("--slot", type=float, help="runSlot of the experiment")
+    parser.add_argument("--delay", type=float, default=0.25,
+                        help="one-way delay of each node's link in ms")
+    parser.add_argument("--loss", type=float, default=0, help="packet loss in percent")
+    parser.add_argument("--nodup", action="store_true",
+                        help="set pairwiseNoDuplication, halving the pairs")
+    parser.add_argument("--preflight", action="store_true",
+                        help="run the preflight reachability check on the nodes")
+    parser.add_argument("--ping-mode", choices=["ping", "kernel"],
+                        help="pingMode of the experiment, default ping for stub, kernel for netns")
+    parser.add_argument("--start-delay", type=float, default=5,
+                        help="startDelay of the experiment in seconds")
+    parser.add_argument("--timeout", type=int, default=3600,
+                        help="seconds after which the master is killed")
+    parser.add_argument("-w", "--workdir", help="directory for the simulated nodes, default a temp dir")
+    parser.add_argument("-k", "--keep", action="store_true", help="keep the workdir")
+    parser.add_argument("-o", "--output", help="write the reports as json to this file")
+    args = parser.parse_args()
+
+    if args.ping_mode is None:
+        args.ping_mode = "kernel" if args.mode == "netns" else "ping"
+    if args.mode == "netns" and os.geteuid() != 0:
+        parser.error("the netns mode needs root")
+    tempdir = args.workdir is None
+    if tempdir:
+        args.workdir = tempfile.mkdtemp(prefix="apsim-")
+
+    reports = []
+    header = "%6s %9s %9s %9s %9s %9s %9s %9s %9s" % ("nodes", "wall_s", "cpu_s", "peak_mb",
+                                                        "rows", "expected", "complete",
+                                                        "journaled", "max_slip")
+    try:
+        for n in args.nodes:
+            print("Simulating %d nodes in %s mode" % (n, args.mode))
+            report = simulate(n, args)
+            reports.append(report)
+            print("  %(wall_s).1f s wall, master %(master_cpu_s).1f s CPU, "
+                  "%(master_peak_mb).1f MB peak, %(rows)d/%(expected_rows)d rows" % report)
+    finally:
+        if tempdir and not args.keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+        elif args.keep:
+            print("Simulated nodes kept in %s" % args.workdir)
+
+    print(header)
+    for r in reports:
+        print("%6d %9.1f %9.2f %9.1f %9d %9d %9d %9d %9.3f" %
+              (r["nodes"], r["wall_s"], r["master_cpu_s"], r["master_peak_mb"], r["rows"],
+               r["expected_rows"], r["nodes_complete"], r["nodes_journaled"], r["max_slip_s"]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()